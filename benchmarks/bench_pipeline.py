@@ -0,0 +1,237 @@
+import argparse
+import json
+import logging
+import os
+import resource
+import subprocess
+import tempfile
+import time
+from benchmarks.mock_server import NATIONAL_CITIES, MockServer
+from src.cube import merge_cubes
+from src.ibge import process_ibge_data
+from src.infodengue import (
+    backfill_api_request,
+    prepare_api_request,
+    process_infodengue_data,
+)
+from src.merge import merge_city, merge_country, merge_hierarchy, merge_uf
+from src.metrics import get_metrics
+from src.pipeline import run_pipeline
+from src.utils import set_logging_config
+
+
+SCALES = {
+    "small": {"cities": 50, "years": 1},
+    "medium": {"cities": 500, "years": 2},
+    "national": {"cities": NATIONAL_CITIES, "years": 1},
+}
+
+
+def peak_rss_mib():
+    # High-water mark of this process and of finished merge workers.
+    self_kib = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children_kib = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+
+    return round(max(self_kib, children_kib) / 1024, 1)
+
+
+def latency_summary(histogram):
+    # Percentiles are reported as the upper bound of their histogram bucket.
+    summary = {
+        "requests": histogram["count"],
+        "mean_s": round(histogram["sum"] / histogram["count"], 4),
+    }
+
+    for quantile in [0.5, 0.95, 0.99]:
+        seen = 0
+        summary[f"p{int(quantile * 100)}_s"] = None
+
+        for bound, count in zip(histogram["buckets"], histogram["counts"]):
+            seen += count
+            if seen >= quantile * histogram["count"]:
+                summary[f"p{int(quantile * 100)}_s"] = bound
+                break
+
+    return summary
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_stage(results, name, func, params, log=False, count=None):
+    metrics = get_metrics()
+    metrics.drain()
+
+    start = time.perf_counter()
+    func(params=params, log=log)
+    elapsed = time.perf_counter() - start
+
+    data = metrics.to_dict()
+    counters = {}
+    for counter in data["counters"]:
+        counters[counter["name"]] = counters.get(counter["name"], 0) + counter["value"]
+
+    result = {
+        "stage": name,
+        "seconds": round(elapsed, 3),
+        "peak_rss_mib": peak_rss_mib(),
+        "requests": counters.get("http_requests", 0),
+        "rows_written": counters.get("rows_written", 0),
+        "bytes_written": counters.get("bytes_written", 0),
+    }
+
+    if count is not None:
+        result["items"] = count
+        result["items_per_s"] = round(count / elapsed, 2) if elapsed else None
+
+    for histogram in data["histograms"]:
+        if histogram["name"] == "http_request_seconds" and histogram["count"]:
+            result["latency"] = latency_summary(histogram)
+
+    results.append(result)
+    print(
+        f"{name:<16} {elapsed:>9.2f}s  {result['peak_rss_mib']:>8.1f} MiB  "
+        f"{result['requests']:>7} req  {result['rows_written']:>10} rows"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the pipeline against a local IBGE/InfoDengue mock."
+    )
+    parser.add_argument("--scale", choices=list(SCALES), default="small")
+    parser.add_argument("--cities", type=int, help="overrides the scale")
+    parser.add_argument("--years", type=int, help="overrides the scale")
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds")
+    parser.add_argument("--throttle", type=float, default=0.0, help="429 ratio")
+    parser.add_argument("--retry-after", type=float, default=1)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--merge-workers", type=int, default=os.cpu_count())
+    parser.add_argument("--rate-limit", type=float, default=50)
+    parser.add_argument("--storage", choices=["csv", "parquet"], default="csv")
+    parser.add_argument("--layout", choices=["wide", "star"], default="wide")
+    parser.add_argument(
+        "--pipeline", action="store_true", help="use run_pipeline instead of phases"
+    )
+    parser.add_argument(
+        "--single-pass",
+        action="store_true",
+        help="use merge_hierarchy instead of merge_city/merge_uf/merge_country",
+    )
+    parser.add_argument("--output", help="write the results as JSON")
+    parser.add_argument("--log", action="store_true")
+    args = parser.parse_args()
+
+    scale = SCALES[args.scale]
+    cities = args.cities or scale["cities"]
+    years = args.years or scale["years"]
+    year = 2024
+
+    if args.log:
+        set_logging_config()
+    else:
+        logging.disable(logging.INFO)
+
+    server = MockServer(
+        cities=cities,
+        latency=args.latency,
+        throttle=args.throttle,
+        retry_after=args.retry_after,
+    ).start()
+
+    cwd = os.getcwd()
+    work_path = tempfile.mkdtemp(prefix="aedes-bench-")
+    os.chdir(work_path)
+
+    params = {
+        "country": "Brasil",
+        "ibge_path": "data/Brasil/_ibge",
+        "ibge_file_name": "ibge_data.csv",
+        "infodengue_file_name": "infodengue_data",
+        "year": year,
+        "year_start": year - years + 1,
+        "year_end": year,
+        "ew_start": 1,
+        "ew_end": 53,
+        "format": "json",
+        "ibge_api": f"{server.url}/api/v1/localidades/distritos",
+        "infodengue_api": f"{server.url}/api/alertcity",
+        "disease_values": ["dengue", "chikungunya"],
+        "list_city": [],
+        "list_uf": [],
+        "workers": args.workers,
+        "rate_limit": args.rate_limit,
+        "manifest_path": "data/Brasil/_state/fetch_state.sqlite",
+        "storage": args.storage,
+        "store_path": "data/_store",
+        "merge_workers": args.merge_workers,
+        "output_layout": args.layout,
+    }
+
+    print(f"Scale: {cities} cities x {years} years, working in '{work_path}'")
+
+    results = []
+    log = args.log
+
+    def ibge(params, log=False):
+        columns = ["mesorregiao_uf", "geocode"]
+        params["ibge_data"] = (
+            process_ibge_data(params=params, log=log)[columns]
+            .sort_values(by=columns)
+            .reset_index(drop=True)
+        )
+        params["infodengue_data"] = process_infodengue_data(params=params, log=log)
+
+    fetch = backfill_api_request if years > 1 else prepare_api_request
+
+    run_stage(results, "ibge", ibge, params, log=log)
+    pairs = len(params["infodengue_data"])
+
+    if args.pipeline:
+        run_stage(results, "pipeline", run_pipeline, params, log=log, count=pairs)
+    else:
+        run_stage(results, "fetch", fetch, params, log=log, count=pairs)
+        run_stage(results, "fetch (rerun)", fetch, params, log=log, count=pairs)
+
+        params["ibge_data"] = process_ibge_data(params=params, log=log)
+        count = len(params["ibge_data"])
+        if args.single_pass:
+            run_stage(
+                results, "merge_hierarchy", merge_hierarchy, params, log=log, count=count
+            )
+        else:
+            run_stage(results, "merge_city", merge_city, params, log=log, count=count)
+            run_stage(results, "merge_uf", merge_uf, params, log=log)
+            run_stage(results, "merge_country", merge_country, params, log=log)
+        run_stage(results, "merge_cubes", merge_cubes, params, log=log)
+
+    server.stop()
+    os.chdir(cwd)
+
+    report = {
+        "commit": git_commit(),
+        "scale": {"cities": cities, "years": years, "pairs": pairs},
+        "config": vars(args),
+        "server": server.stats,
+        "stages": results,
+        "total_seconds": round(sum(result["seconds"] for result in results), 3),
+    }
+
+    print(f"Total: {report['total_seconds']:.2f}s, server: {server.stats}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
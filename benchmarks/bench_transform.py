@@ -0,0 +1,123 @@
+import argparse
+import time
+import numpy as np
+import pandas as pd
+from src.merge import (
+    data_nivel_inc,
+    data_receptivo,
+    data_transmissao,
+    drop_columns,
+    transform_columns,
+)
+from src.schema import RAW_COLUMNS
+
+
+def transform_columns_apply(df, log=False):
+    # transform_columns before vectorization, kept as the baseline.
+    df["tweet"] = 0
+    df = drop_columns(df, log=log)
+
+    columns = [
+        "casos_est",
+        "casos_est_min",
+        "casos_est_max",
+        "casos",
+        "pop",
+        "notif_accum_year",
+    ]
+    df[columns] = df[columns].fillna(0).astype(int)
+
+    df = df.round(
+        {
+            "p_rt1": 2,
+            "p_inc100k": 4,
+            "Rt": 2,
+            "tempmin": 2,
+            "tempmed": 2,
+            "tempmax": 2,
+            "umidmin": 2,
+            "umidmed": 2,
+            "umidmax": 2,
+        }
+    )
+
+    df["receptivo"] = df["receptivo"].apply(data_receptivo)
+    df["transmissao"] = df["transmissao"].fillna(0).apply(data_transmissao)
+    df["nivel_inc"] = df["nivel_inc"].apply(data_nivel_inc)
+
+    df["year"] = df["SE"] // 100
+    df["SE"] = df["SE"] % 100
+
+    return df
+
+
+def synthetic_frame(cities, years, diseases=2, seed=0):
+    rng = np.random.default_rng(seed)
+
+    geocode = np.repeat(np.arange(cities) + 1100015, diseases * years * 52)
+    disease = np.tile(
+        np.repeat(np.array(["dengue", "chikungunya", "zika"][:diseases]), years * 52),
+        cities,
+    )
+    se = np.tile(
+        (np.repeat(np.arange(2024 - years + 1, 2025), 52) * 100)
+        + np.tile(np.arange(1, 53), years),
+        cities * diseases,
+    )
+    rows = len(geocode)
+
+    df = pd.DataFrame(
+        {column: rng.random(rows) * 100 for column in RAW_COLUMNS}
+    )
+    df["disease"] = disease
+    df["geocode"] = geocode
+    df["SE"] = se
+    df["versao_modelo"] = "2024-01-01"
+    df["receptivo"] = rng.integers(0, 4, rows).astype(float)
+    df["transmissao"] = np.where(
+        rng.random(rows) < 0.05, np.nan, rng.integers(0, 4, rows)
+    )
+    df["nivel_inc"] = rng.integers(0, 3, rows).astype(float)
+    df["casprov"] = np.nan
+
+    return df
+
+
+def bench(func, df, repeat):
+    times = []
+    for _ in range(repeat):
+        df_copy = df.copy()
+        start = time.perf_counter()
+        result = func(df_copy)
+        times.append(time.perf_counter() - start)
+
+    return min(times), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark transform_columns.")
+    parser.add_argument(
+        "--cities",
+        type=int,
+        default=1000,
+        help="5570 reproduces the national frame (needs ~12 GB of RAM)",
+    )
+    parser.add_argument("--years", type=int, default=15)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    df = synthetic_frame(args.cities, args.years)
+    print(f"Rows: {len(df):,}")
+
+    time_apply, df_apply = bench(transform_columns_apply, df, args.repeat)
+    time_vector, df_vector = bench(transform_columns, df, args.repeat)
+
+    for column in ["receptivo", "transmissao", "nivel_inc"]:
+        assert (df_apply[column] == df_vector[column].astype(str)).all(), column
+
+    print(f"apply:      {time_apply:.3f}s")
+    print(f"vectorized: {time_vector:.3f}s ({time_apply / time_vector:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,255 @@
+import hashlib
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+# (IBGE id, sigla, nome, regiao, municipalities) for the 27 UFs; the counts
+# add up to the 5570 municipalities of a national run.
+UFS = [
+    (11, "RO", "Rondônia", "Norte", 52),
+    (12, "AC", "Acre", "Norte", 22),
+    (13, "AM", "Amazonas", "Norte", 62),
+    (14, "RR", "Roraima", "Norte", 15),
+    (15, "PA", "Pará", "Norte", 144),
+    (16, "AP", "Amapá", "Norte", 16),
+    (17, "TO", "Tocantins", "Norte", 139),
+    (21, "MA", "Maranhão", "Nordeste", 217),
+    (22, "PI", "Piauí", "Nordeste", 224),
+    (23, "CE", "Ceará", "Nordeste", 184),
+    (24, "RN", "Rio Grande do Norte", "Nordeste", 167),
+    (25, "PB", "Paraíba", "Nordeste", 223),
+    (26, "PE", "Pernambuco", "Nordeste", 185),
+    (27, "AL", "Alagoas", "Nordeste", 102),
+    (28, "SE", "Sergipe", "Nordeste", 75),
+    (29, "BA", "Bahia", "Nordeste", 417),
+    (31, "MG", "Minas Gerais", "Sudeste", 853),
+    (32, "ES", "Espírito Santo", "Sudeste", 78),
+    (33, "RJ", "Rio de Janeiro", "Sudeste", 92),
+    (35, "SP", "São Paulo", "Sudeste", 645),
+    (41, "PR", "Paraná", "Sul", 399),
+    (42, "SC", "Santa Catarina", "Sul", 295),
+    (43, "RS", "Rio Grande do Sul", "Sul", 497),
+    (50, "MS", "Mato Grosso do Sul", "Centro-Oeste", 79),
+    (51, "MT", "Mato Grosso", "Centro-Oeste", 141),
+    (52, "GO", "Goiás", "Centro-Oeste", 246),
+    (53, "DF", "Distrito Federal", "Centro-Oeste", 1),
+]
+
+REGIOES = {
+    "Norte": (1, "N"),
+    "Nordeste": (2, "NE"),
+    "Sudeste": (3, "SE"),
+    "Sul": (4, "S"),
+    "Centro-Oeste": (5, "CO"),
+}
+
+NATIONAL_CITIES = sum(uf[4] for uf in UFS)
+
+
+def ibge_districts(cities=NATIONAL_CITIES, seed=0):
+    # Same nesting as servicodados.ibge.gov.br/api/v1/localidades/distritos:
+    # one to three districts per municipality, municipalities spread across
+    # UFs in proportion to the real counts.
+    rng = random.Random(seed)
+    list_district = []
+
+    for uf_id, sigla, nome, regiao, count in UFS:
+        regiao_id, regiao_sigla = REGIOES[regiao]
+        uf = {
+            "id": uf_id,
+            "sigla": sigla,
+            "nome": nome,
+            "regiao": {"id": regiao_id, "sigla": regiao_sigla, "nome": regiao},
+        }
+
+        for index in range(max(1, round(count * cities / NATIONAL_CITIES))):
+            geocode = uf_id * 100000 + index * 7 + 1
+            group = index // 40
+
+            municipio = {
+                "id": geocode,
+                "nome": f"{nome} {index:04d}",
+                "microrregiao": {
+                    "id": uf_id * 1000 + group,
+                    "nome": f"Microrregião {sigla} {group}",
+                    "mesorregiao": {
+                        "id": uf_id * 100 + group // 4,
+                        "nome": f"Mesorregião {sigla} {group // 4}",
+                        "UF": uf,
+                    },
+                },
+                "regiao-imediata": {
+                    "id": uf_id * 10000 + group,
+                    "nome": f"Região Imediata {sigla} {group}",
+                    "regiao-intermediaria": {
+                        "id": uf_id * 100 + group // 3,
+                        "nome": f"Região Intermediária {sigla} {group // 3}",
+                        "UF": uf,
+                    },
+                },
+            }
+
+            for district in range(rng.randint(1, 3)):
+                list_district.append(
+                    {
+                        "id": geocode * 100 + district + 5,
+                        "nome": f"Distrito {district}",
+                        "municipio": municipio,
+                    }
+                )
+
+    return list_district
+
+
+def alertcity_rows(geocode, disease, ew_start, ew_end, ey_start, ey_end):
+    # One row per epidemiological week, newest first, with the field set of
+    # info.dengue.mat.br/api/alertcity. Values are seeded by request so
+    # repeated runs serve identical bodies (and ETags).
+    rng = random.Random(f"{geocode}-{disease}-{ey_start}-{ew_start}")
+    list_row = []
+
+    for year in range(ey_start, ey_end + 1):
+        first = ew_start if year == ey_start else 1
+        last = ew_end if year == ey_end else 52
+
+        for week in range(first, last + 1):
+            casos = rng.randint(0, 400)
+            list_row.append(
+                {
+                    "data_iniSE": 1704067200000 + week * 604800000,
+                    "SE": year * 100 + week,
+                    "casos_est": casos * 1.1,
+                    "casos_est_min": casos,
+                    "casos_est_max": casos * 1.3,
+                    "casos": casos,
+                    "p_rt1": rng.random(),
+                    "p_inc100k": rng.random() * 50,
+                    "Localidade_id": 0,
+                    "nivel": rng.randint(1, 4),
+                    "id": geocode * 1000000 + year * 100 + week,
+                    "versao_modelo": f"{year}-{week:02d}-01",
+                    "tweet": None,
+                    "Rt": rng.random() * 2,
+                    "pop": 25000.0,
+                    "tempmin": 15 + rng.random() * 10,
+                    "umidmax": 70 + rng.random() * 30,
+                    "receptivo": rng.randint(0, 3),
+                    "transmissao": rng.randint(0, 3),
+                    "nivel_inc": rng.randint(0, 2),
+                    "umidmed": 60 + rng.random() * 30,
+                    "umidmin": 40 + rng.random() * 30,
+                    "tempmed": 20 + rng.random() * 10,
+                    "tempmax": 25 + rng.random() * 10,
+                    "casprov": None,
+                    "casprov_est": None,
+                    "casprov_est_min": None,
+                    "casprov_est_max": None,
+                    "casconf": None,
+                    "notif_accum_year": casos * week,
+                }
+            )
+
+    list_row.reverse()
+    return list_row
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        server.count("requests")
+
+        if server.latency:
+            time.sleep(server.latency)
+
+        if server.throttle and server.random() < server.throttle:
+            server.count("throttled")
+            self.send_empty(429, {"Retry-After": f"{server.retry_after:g}"})
+            return
+
+        url = urlparse(self.path)
+        query = {key: value[0] for key, value in parse_qs(url.query).items()}
+
+        if url.path.endswith("/localidades/distritos"):
+            body = server.districts
+        elif url.path.endswith("/alertcity"):
+            body = json.dumps(
+                alertcity_rows(
+                    int(query["geocode"]),
+                    query["disease"],
+                    int(query["ew_start"]),
+                    int(query["ew_end"]),
+                    int(query["ey_start"]),
+                    int(query["ey_end"]),
+                )
+            ).encode()
+        else:
+            self.send_empty(404)
+            return
+
+        etag = f'"{hashlib.md5(body).hexdigest()}"'
+        if self.headers.get("If-None-Match") == etag:
+            server.count("not_modified")
+            self.send_empty(304, {"ETag": etag})
+            return
+
+        server.count("bytes", len(body))
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_empty(self, status, headers=None):
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+
+# Local stand-in for the IBGE and InfoDengue APIs with configurable latency
+# (seconds per request) and 429 injection (fraction of requests throttled).
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, cities=50, latency=0.0, throttle=0.0, retry_after=1, seed=0):
+        super().__init__(("127.0.0.1", 0), MockHandler)
+
+        self.latency = latency
+        self.throttle = throttle
+        self.retry_after = retry_after
+        self.districts = json.dumps(ibge_districts(cities, seed=seed)).encode()
+
+        self.stats = {"requests": 0, "throttled": 0, "not_modified": 0, "bytes": 0}
+        self.lock = threading.Lock()
+        self.rng = random.Random(seed)
+
+    def count(self, key, value=1):
+        with self.lock:
+            self.stats[key] += value
+
+    def random(self):
+        with self.lock:
+            return self.rng.random()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_port}"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
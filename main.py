@@ -1,6 +1,16 @@
+import argparse
+import os
+from src.cube import merge_cubes
 from src.ibge import process_ibge_data
-from src.infodengue import prepare_api_request, process_infodengue_data
-from src.merge import merge_city, merge_country, merge_uf
+from src.infodengue import (
+    backfill_api_request,
+    prepare_api_request,
+    process_infodengue_data,
+)
+from src.merge import merge_city, merge_hierarchy
+from src.metrics import configure_metrics, write_metrics
+from src.pipeline import run_pipeline
+from src.shard import configure_shard, coordinate_shards, write_shard_report
 from src.utils import set_logging_config
 import pandas as pd
 
@@ -10,9 +20,29 @@ set_logging_config()
 log = True
 
 check_infodengue = False
+backfill = False
 merge = False
+pipeline = False  # fetch, merge and write in one streaming pass
+
+# Sharded national runs: N workers (one box or several nodes) each run
+# `main.py --shard i/N`, then one `main.py --coordinate N` merges UF/country.
+parser = argparse.ArgumentParser()
+parser.add_argument("--shard", help="fetch and merge only shard i of N, e.g. 0/4")
+parser.add_argument("--shard-by", choices=["geocode", "uf"], default="geocode")
+parser.add_argument(
+    "--coordinate", type=int, metavar="N", help="merge the outputs of N shards"
+)
+parser.add_argument(
+    "--shard-path",
+    action="append",
+    default=[],
+    help="per-shard output tree to gather from (repeatable)",
+)
+args = parser.parse_args()
 
 year = 2024
+year_start = 2010  # backfill range
+year_end = year
 list_uf = []  # ["MG",] # "ES", "SP"]
 list_city = (
     []
@@ -23,8 +53,13 @@ params = {
     "country": "Brasil",
     "ibge_path": "data/Brasil/_ibge",
     "ibge_file_name": "ibge_data.csv",
+    "ibge_snapshot": True,  # memory-mapped ibge_data.feather next to the CSV
+    "ibge_refresh": False,  # re-download the IBGE table on this run
+    "ibge_max_age_days": None,  # or re-download once the CSV is this old
     "infodengue_file_name": "infodengue_data",
     "year": year,
+    "year_start": year_start,
+    "year_end": year_end,
     "ew_start": 1,
     "ew_end": 53,
     "format": "json",
@@ -33,8 +68,35 @@ params = {
     "disease_values": ["dengue", "chikungunya"],  # zika
     "list_city": list_city,
     "list_uf": list_uf,
+    "workers": 8,
+    "rate_limit": 10,  # requests/s, adapted on HTTP 429
+    "manifest_path": "data/Brasil/_state/fetch_state.sqlite",
+    "manifest_ttl": None,  # e.g. "7D" to refetch revised weeks
+    "cache_path": "data/Brasil/_cache",
+    "cache_ttl": 3600,  # seconds before a cached response is revalidated
+    "cache_max_size": 1024**3,  # bytes, least recently used entries evicted
+    "storage": "csv",  # or "parquet" for the partitioned store below
+    "store_path": "data/_store",
+    "store_max_fragments": 8,  # per geocode and partition, then compacted
+    "merge_fingerprint": "stat",  # or "hash" to compare file contents
+    "merge_workers": os.cpu_count(),
+    "merge_levels": [],  # e.g. ["microrregiao", "regiao_imediata"] per region
+    "pipeline_queue_size": 64,  # cities buffered between pipeline stages
+    "output_layout": "wide",  # or "star": slim facts + IBGE dimension
+    "sql_threads": os.cpu_count(),  # src/sql.py, needs the optional duckdb
+    "sql_memory_limit": "4GB",  # larger aggregations spill to disk
+    "metrics_path": "data/Brasil/_metrics",  # metrics.json + metrics.prom
+    "profile_stages": {},  # e.g. {"merge_city": ["cprofile", "tracemalloc"]}
+    "profile_path": "data/Brasil/_profile",
+    "shard": args.shard,  # "i/N"
+    "shard_by": args.shard_by,  # "geocode" (stable hash) or "uf" (whole UFs)
+    "shard_count": args.coordinate,
+    "shard_paths": args.shard_path,  # empty: all shards share this tree
 }
 
+configure_shard(params, log=log)
+configure_metrics(params)
+
 columns = ["mesorregiao_uf", "geocode"]
 df_ibge = (
     process_ibge_data(params=params, log=log)[columns]
@@ -51,17 +113,45 @@ params["infodengue_data"] = df_infodengue
 if check_infodengue:
     prepare_api_request(params=params, log=log)
 
+if backfill:
+    backfill_api_request(params=params, log=log)
+
+if pipeline:
+    run_pipeline(params=params, log=log)
+
 if merge:
     df_ibge = process_ibge_data(params=params, log=log)
     params["ibge_data"] = df_ibge
 
-    merge_city(params=params, log=log)
-    merge_uf(params=params, log=log)
-    merge_country(params=params, log=log)
+    if params["shard"]:
+        merge_city(params=params, log=log)
+        write_shard_report(params, log=log)
+    else:
+        # merge_city, merge_uf and merge_country in a single pass
+        merge_hierarchy(params=params, log=log)
+        merge_cubes(params=params, log=log)
+
+if args.coordinate:
+    params["ibge_data"] = process_ibge_data(params=params, log=log)
+
+    coordinate_shards(params=params, log=log)
+
+write_metrics(params, log=log)
+
+# path = "data/Brasil/infodengue_data_brasil.parquet"
 
-    # path = "data/Brasil/infodengue_data_brasil.parquet"
+# df = pd.read_parquet(path)
 
-    # df = pd.read_parquet(path)
+# Filters and columns are pushed down instead of loading the whole file,
+# and query_cube answers the same call from data/Brasil/_cubes when it can:
+# df_u = query_cube(
+#     params,
+#     list_uf=["MG"],
+#     list_disease=["dengue"],
+#     years=range(2010, 2025),
+#     group_by=["mesorregiao_uf", "disease", "year"],
+#     agg={"sum": ("casos", "sum")},
+# )
 
 # mask_u = df["mesorregiao_uf"] == "MG"
 # mask_c = df["municipio"] == "Divinópolis"
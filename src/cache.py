@@ -0,0 +1,224 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from urllib.parse import parse_qsl, urlencode, urlparse, urlunparse
+from src.utils import check_dir
+
+
+def normalize_url(url):
+    parts = urlparse(url)
+    query = sorted((k, v) for k, v in parse_qsl(parts.query) if v != "")
+
+    return urlunparse(
+        (
+            parts.scheme.lower(),
+            parts.netloc.lower(),
+            parts.path,
+            "",
+            urlencode(query),
+            "",
+        )
+    )
+
+
+# On-disk HTTP response cache: bodies live in `cache_path/xx/<sha256>` and a
+# SQLite index keeps validators, timestamps and sizes for TTL, ETag /
+# Last-Modified revalidation and LRU eviction once `max_size` bytes is hit.
+class ResponseCache:
+    def __init__(self, cache_path, ttl=3600, max_size=1024**3, log=False):
+        self.cache_path = cache_path
+        self.ttl = ttl
+        self.max_size = max_size
+        self.log = log
+
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self.evicted = 0
+
+        self.lock = threading.Lock()
+
+        check_dir(cache_path, log=log)
+        self.conn = sqlite3.connect(
+            os.path.join(cache_path, "index.sqlite"), check_same_thread=False
+        )
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                url TEXT NOT NULL,
+                etag TEXT,
+                last_modified TEXT,
+                fetched_at REAL NOT NULL,
+                accessed_at REAL NOT NULL,
+                size INTEGER NOT NULL
+            )
+            """
+        )
+        self.conn.commit()
+
+    def _key(self, url):
+        return hashlib.sha256(normalize_url(url).encode()).hexdigest()
+
+    def _body_path(self, key):
+        return os.path.join(self.cache_path, key[:2], key)
+
+    def get(self, url):
+        key = self._key(url)
+
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT etag, last_modified, fetched_at FROM responses WHERE key = ?",
+                (key,),
+            ).fetchone()
+
+        body = None
+        if row is not None:
+            # put() may evict the body between the lookup and the read.
+            try:
+                with open(self._body_path(key), "rb") as f:
+                    body = f.read()
+            except FileNotFoundError:
+                pass
+
+        if body is None:
+            with self.lock:
+                self.misses += 1
+            return None
+
+        etag, last_modified, fetched_at = row
+        fresh = time.time() - fetched_at < self.ttl
+
+        if not fresh:
+            with self.lock:
+                self.misses += 1
+
+        return {
+            "key": key,
+            "body": body,
+            "etag": etag,
+            "last_modified": last_modified,
+            "fresh": fresh,
+        }
+
+    def validators(self, entry):
+        headers = {}
+        if entry is None:
+            return headers
+
+        if entry["etag"]:
+            headers["If-None-Match"] = entry["etag"]
+        if entry["last_modified"]:
+            headers["If-Modified-Since"] = entry["last_modified"]
+
+        return headers
+
+    def hit(self, entry):
+        with self.lock:
+            self.hits += 1
+            self.conn.execute(
+                "UPDATE responses SET accessed_at = ? WHERE key = ?",
+                (time.time(), entry["key"]),
+            )
+            self.conn.commit()
+
+        return entry["body"]
+
+    def refresh(self, entry):
+        with self.lock:
+            self.revalidated += 1
+            now = time.time()
+            self.conn.execute(
+                "UPDATE responses SET fetched_at = ?, accessed_at = ? WHERE key = ?",
+                (now, now, entry["key"]),
+            )
+            self.conn.commit()
+
+        return entry["body"]
+
+    def put(self, url, body, etag=None, last_modified=None):
+        key = self._key(url)
+        body_path = self._body_path(key)
+
+        check_dir(os.path.dirname(body_path))
+        tmp_path = f"{body_path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(body)
+        os.replace(tmp_path, body_path)
+
+        with self.lock:
+            now = time.time()
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, normalize_url(url), etag, last_modified, now, now, len(body)),
+            )
+            self.conn.commit()
+            self._evict()
+
+    def _evict(self):
+        (total,) = self.conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()
+
+        if total <= self.max_size:
+            return
+
+        for key, size in self.conn.execute(
+            "SELECT key, size FROM responses ORDER BY accessed_at"
+        ).fetchall():
+            if total <= self.max_size:
+                break
+
+            self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            if os.path.exists(self._body_path(key)):
+                os.remove(self._body_path(key))
+
+            total -= size
+            self.evicted += 1
+
+        self.conn.commit()
+
+        if self.log:
+            logging.info(f"Cache evicted down to {total} bytes...")
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "revalidated": self.revalidated,
+            "evicted": self.evicted,
+        }
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_response_cache(cache_path, ttl=3600, max_size=1024**3, log=False):
+    with _caches_lock:
+        cache = _caches.get(cache_path)
+
+        if cache is None:
+            if log:
+                logging.info(f"Caching HTTP responses at '{cache_path}'...")
+
+            cache = ResponseCache(cache_path, ttl=ttl, max_size=max_size, log=log)
+            _caches[cache_path] = cache
+
+    return cache
+
+
+def get_cache(params, log=False):
+    cache_path = params.get("cache_path")
+
+    if cache_path:
+        return get_response_cache(
+            cache_path,
+            ttl=params.get("cache_ttl", 3600),
+            max_size=params.get("cache_max_size", 1024**3),
+            log=log,
+        )
@@ -0,0 +1,298 @@
+import logging
+import os
+import pandas as pd
+from src.geography import get_geography
+from src.merge import read_fingerprint, write_fingerprint
+from src.metrics import instrument
+from src.query import query
+from src.star import get_country_path
+from src.utils import check_dir, check_file, set_csv_path
+
+
+# Materialised rollups of the weekly city data. Every cube stores the same
+# measures: case sums and the number of weekly rows behind them, so means
+# can be derived after further rollups.
+CUBES = {
+    "uf_year": ["mesorregiao_uf", "disease", "year"],
+    "region_week": ["mesorregiao_uf_regiao_nome", "disease", "year", "SE"],
+    "city_year": ["geocode", "municipio", "mesorregiao_uf", "disease", "year"],
+}
+
+CUBE_MEASURES = ["casos", "casos_est"]
+
+
+def get_cube_path(params, name):
+    return os.path.join(get_country_path(params), "_cubes", f"{name}.parquet")
+
+
+def rollup(df, keys):
+    return (
+        df.groupby(keys, observed=True)
+        .agg(
+            **{measure: (measure, "sum") for measure in CUBE_MEASURES},
+            weeks=("casos", "size"),
+        )
+        .reset_index()
+    )
+
+
+def rollup_cube(df, keys):
+    # No keys: one total row, or none when nothing matched (as query() does).
+    if not keys:
+        df = df[[*CUBE_MEASURES, "weeks"]]
+        return df.sum().to_frame().T if len(df) else df.reset_index(drop=True)
+
+    return (
+        df.groupby(keys, observed=True)[[*CUBE_MEASURES, "weeks"]]
+        .sum()
+        .reset_index()
+    )
+
+
+def get_cube_state_path(params):
+    return os.path.join(get_country_path(params), "_cubes", "_cube_state.json")
+
+
+def cube_inputs(params, df_ibge):
+    # Size/mtime of every city file the cubes are built from, by geocode.
+    file_name = f"{params['infodengue_file_name']}.parquet"
+    inputs = {}
+
+    for geocode, csv_path in zip(df_ibge["geocode"], df_ibge["csv_path"]):
+        file_path = os.path.join(csv_path, file_name)
+
+        if os.path.exists(file_path):
+            stat = os.stat(file_path)
+            inputs[str(int(geocode))] = [stat.st_size, stat.st_mtime_ns]
+
+    return inputs
+
+
+def write_cube(df, file_path, log=False):
+    check_dir(os.path.dirname(file_path))
+
+    df.to_parquet(f"{file_path}.tmp", index=False)
+    os.replace(f"{file_path}.tmp", file_path)
+
+    if log:
+        logging.info(f"Cube '{file_path}' written with {len(df)} rows...")
+
+
+def read_cities(params, df_ibge, log=False):
+    file_name = f"{params['infodengue_file_name']}.parquet"
+    columns = ["disease", "year", "SE", *CUBE_MEASURES]
+
+    list_df = []
+
+    for geocode, csv_path in zip(df_ibge["geocode"], df_ibge["csv_path"]):
+        file_path = os.path.join(csv_path, file_name)
+
+        if check_file(file_path, type="parquet"):
+            list_df.append(
+                pd.read_parquet(file_path, columns=columns).assign(geocode=geocode)
+            )
+
+    if log:
+        logging.info(f"Read cube inputs from {len(list_df)} cities...")
+
+    if not list_df:
+        return pd.DataFrame(columns=["geocode", *columns])
+
+    return pd.concat(list_df, ignore_index=True).astype({"disease": "category"})
+
+
+@instrument("merge_cubes")
+def merge_cubes(params, log=False):
+    # Incremental on the city files changed since the cubes were last built,
+    # as recorded in their own state file (not this run's `dirty_city`, which
+    # misses cities merged by a run that stopped before reaching the cubes):
+    # their rows replace the old ones in the city cube, the UF cube is rolled
+    # up from it, and only regions holding them are rebuilt.
+    df_ibge = params["ibge_data"].assign(csv_path=set_csv_path(params, log=log))
+
+    city_path = get_cube_path(params, "city_year")
+    region_path = get_cube_path(params, "region_week")
+    state_path = get_cube_state_path(params)
+
+    state = read_fingerprint(state_path)
+    content_hash = get_geography(params).content_hash
+    inputs = cube_inputs(params, df_ibge)
+
+    incremental = (
+        state is not None
+        and state.get("ibge_sha256") == content_hash
+        and check_file(city_path, type="parquet")
+        and check_file(region_path, type="parquet")
+    )
+
+    if incremental:
+        dirty_city = {
+            int(geocode)
+            for geocode in df_ibge["geocode"].astype(int).astype(str)
+            if inputs.get(geocode) != state["cities"].get(geocode)
+        }
+
+    if incremental and not dirty_city:
+        if log:
+            logging.info(f"Cubes unchanged, skipping...")
+        return
+
+    geography = df_ibge[
+        ["geocode", "municipio", "mesorregiao_uf", "mesorregiao_uf_regiao_nome"]
+    ]
+
+    if incremental:
+        df_dirty = df_ibge[df_ibge["geocode"].isin(dirty_city)]
+        list_region = df_dirty["mesorregiao_uf_regiao_nome"].unique().tolist()
+        df_region_city = df_ibge[
+            df_ibge["mesorregiao_uf_regiao_nome"].isin(list_region)
+        ]
+    else:
+        list_region = None
+        df_region_city = df_ibge
+
+    if log:
+        logging.info(f"Updating cubes from {len(df_region_city)} cities...")
+
+    # Region weeks need every city of an affected region; the dirty cities
+    # are a subset of those, so one read feeds both cubes.
+    df_week = read_cities(params, df_region_city, log=log).merge(
+        geography, on="geocode"
+    )
+
+    if incremental:
+        df_city = rollup(
+            df_week[df_week["geocode"].isin(dirty_city)], CUBES["city_year"]
+        )
+        df_old = pd.read_parquet(city_path)
+        df_city = pd.concat(
+            [df_old[~df_old["geocode"].isin(dirty_city)], df_city], ignore_index=True
+        )
+    else:
+        df_city = rollup(df_week, CUBES["city_year"])
+
+    df_city = df_city.astype(
+        {"municipio": "category", "mesorregiao_uf": "category", "disease": "category"}
+    ).sort_values(by=CUBES["city_year"], ignore_index=True)
+
+    write_cube(df_city, city_path, log=log)
+
+    write_cube(
+        rollup_cube(df_city, CUBES["uf_year"]),
+        get_cube_path(params, "uf_year"),
+        log=log,
+    )
+
+    df_region = rollup(df_week, CUBES["region_week"])
+
+    if list_region is not None:
+        df_old = pd.read_parquet(region_path)
+        df_region = pd.concat(
+            [
+                df_old[~df_old["mesorregiao_uf_regiao_nome"].isin(list_region)],
+                df_region,
+            ],
+            ignore_index=True,
+        )
+
+    df_region = df_region.astype(
+        {"mesorregiao_uf_regiao_nome": "category", "disease": "category"}
+    ).sort_values(by=CUBES["region_week"], ignore_index=True)
+
+    write_cube(df_region, region_path, log=log)
+
+    # Cities outside `ibge_data` (a UF/city selection) keep their state, as
+    # their rows were kept in the cubes above.
+    cities = inputs
+    if incremental:
+        selected = set(df_ibge["geocode"].astype(int).astype(str))
+        cities = {
+            **{
+                geocode: value
+                for geocode, value in state["cities"].items()
+                if geocode not in selected
+            },
+            **inputs,
+        }
+
+    write_fingerprint(state_path, {"ibge_sha256": content_hash, "cities": cities})
+
+
+def find_cube(group_by, agg, filter_columns):
+    # First (smallest) cube whose keys cover the grouping and filter columns
+    # and whose measures can answer every aggregation.
+    for name, keys in CUBES.items():
+        if not set(group_by) | set(filter_columns) <= set(keys):
+            continue
+
+        if all(
+            column in CUBE_MEASURES and func in ["sum", "count", "mean"]
+            for column, func in agg.values()
+        ):
+            return name
+
+    return None
+
+
+def query_cube(
+    params,
+    group_by,
+    agg,
+    list_uf=None,
+    list_city=None,
+    list_disease=None,
+    years=None,
+    log=False,
+):
+    # Same arguments and result as query(..., group_by=..., agg=...), served
+    # from a cube when one covers the request and from the data otherwise.
+    dict_filter = {
+        column: value
+        for column, value in [
+            ("mesorregiao_uf", list_uf),
+            ("municipio", list_city),
+            ("disease", list_disease),
+            ("year", years),
+        ]
+        if value is not None and (column == "year" or value)
+    }
+
+    name = find_cube(group_by, agg, dict_filter)
+
+    if name is None or not check_file(get_cube_path(params, name), type="parquet"):
+        if log:
+            logging.info(f"No cube covers {group_by} / {agg}, querying data...")
+
+        return query(
+            params,
+            list_uf=list_uf,
+            list_city=list_city,
+            list_disease=list_disease,
+            years=years,
+            group_by=group_by,
+            agg=agg,
+            log=log,
+        )
+
+    if log:
+        logging.info(f"Answering from cube '{name}'...")
+
+    df = pd.read_parquet(get_cube_path(params, name))
+
+    for column, value in dict_filter.items():
+        df = df[df[column].isin(list(value))]
+
+    df = rollup_cube(df, group_by)
+    if group_by:
+        df = df.set_index(group_by)
+
+    return pd.DataFrame(
+        {
+            output: (
+                df[column]
+                if func == "sum"
+                else df["weeks"] if func == "count" else df[column] / df["weeks"]
+            )
+            for output, (column, func) in agg.items()
+        }
+    )
@@ -0,0 +1,227 @@
+import hashlib
+import json
+import logging
+import os
+import time
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+from src.metrics import get_metrics
+from src.schema import DIMENSION_COLUMNS, GEOGRAPHY_COLUMNS
+
+
+# Bumped whenever the snapshot layout or the column dtypes change, so old
+# snapshots are rebuilt from the CSV instead of being misread.
+SNAPSHOT_VERSION = 2
+
+# Everything but geocode and municipio repeats across cities.
+CATEGORY_COLUMNS = [column for column in GEOGRAPHY_COLUMNS if column != "municipio"]
+
+# One Geography per IBGE file and country, rebuilt when the file's size or
+# mtime changes.
+_geography = {}
+
+
+# The IBGE table loaded once, with compact dtypes, a hash index on geocode
+# and the city/UF output paths built in one vectorized pass; set_csv_path
+# looks paths up here instead of rebuilding them on every call.
+class Geography:
+    def __init__(self, df, country, content_hash=None):
+        df = df.reindex(columns=DIMENSION_COLUMNS)
+        df = df.astype({"geocode": "int32"})
+        df = df.astype({column: "category" for column in CATEGORY_COLUMNS})
+
+        self.country = country
+        self.content_hash = content_hash
+        self.df = df.reset_index(drop=True)
+        self.index = pd.Index(self.df["geocode"])
+        self.paths = pd.DataFrame(
+            {
+                "csv_path": path_column(self.df, country),
+                "uf_path": path_column(self.df, country, level="uf"),
+            }
+        ).set_index(self.index)
+
+    def __len__(self):
+        return len(self.df)
+
+    def select(self, list_uf=None, list_city=None, log=False):
+        df = self.df
+
+        if list_uf:
+            if log:
+                logging.info(f"Masking uf {list_uf}...")
+            df = df[df["mesorregiao_uf"].isin(list_uf)]
+
+        if list_city:
+            if log:
+                logging.info(f"Masking city {list_city}...")
+            df = df[df["municipio"].isin(list_city)]
+
+        # Filtered frames drop the categories they no longer use, so groupbys
+        # and value_counts downstream only see the selected UFs.
+        df = df.copy()
+        for column in CATEGORY_COLUMNS:
+            df[column] = df[column].cat.remove_unused_categories()
+
+        return df
+
+    def get_paths(self, geocodes, level="city"):
+        # Paths of many geocodes at once; unknown geocodes come back as NaN.
+        column = "uf_path" if level == "uf" else "csv_path"
+        positions = self.index.get_indexer(geocodes)
+
+        values = self.paths[column].to_numpy()[positions].astype(object)
+        values[positions < 0] = np.nan
+
+        return values
+
+
+def path_column(df, country, level="city"):
+    # data/{country}, data/{country}/{uf} and data/{country}/{uf}/{geocode},
+    # built from the UF categories instead of once per row.
+    if level == "country":
+        return pd.Series(f"data/{country}", index=df.index, dtype=object)
+
+    uf = df["mesorregiao_uf"].astype("category")
+    uf_path = uf.cat.rename_categories(
+        [f"data/{country}/{value.lower()}" for value in uf.cat.categories]
+    ).astype(object)
+
+    if level == "uf":
+        return uf_path
+
+    return uf_path + "/" + df["geocode"].astype("int64").astype(str)
+
+
+def read_geography(file_path):
+    return pd.read_csv(file_path)
+
+
+def get_snapshot_path(ibge_file_path):
+    return os.path.splitext(ibge_file_path)[0] + ".feather"
+
+
+def file_hash(file_path):
+    digest = hashlib.sha256()
+
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def read_snapshot(snapshot_path, ibge_file_path, log=False):
+    # Returns (df, content_hash), or None when the snapshot is missing, from
+    # another SNAPSHOT_VERSION or no longer matches the CSV. A CSV that was
+    # only touched (same content hash) keeps its snapshot.
+    if not os.path.isfile(snapshot_path):
+        return None
+
+    try:
+        table = feather.read_table(snapshot_path, memory_map=True)
+    except (OSError, pa.ArrowInvalid) as e:
+        logging.warning(f"Unreadable IBGE snapshot '{snapshot_path}': {e!r}")
+        return None
+
+    metadata = json.loads((table.schema.metadata or {}).get(b"aedes", b"{}"))
+    if metadata.get("version") != SNAPSHOT_VERSION:
+        return None
+
+    stat = os.stat(ibge_file_path)
+    if metadata.get("source") != [stat.st_size, stat.st_mtime_ns]:
+        if file_hash(ibge_file_path) != metadata.get("sha256"):
+            if log:
+                logging.info(f"IBGE snapshot '{snapshot_path}' is stale...")
+            return None
+
+        write_snapshot(table, snapshot_path, ibge_file_path, metadata["sha256"])
+
+    return table.to_pandas(), metadata["sha256"]
+
+
+def write_snapshot(data, snapshot_path, ibge_file_path, content_hash, log=False):
+    # Uncompressed Arrow IPC, so later runs memory-map it instead of parsing.
+    # Categorical columns are stored as dictionaries and come back as such.
+    if isinstance(data, pd.DataFrame):
+        data = pa.Table.from_pandas(data, preserve_index=False)
+
+    stat = os.stat(ibge_file_path)
+    metadata = {
+        "version": SNAPSHOT_VERSION,
+        "sha256": content_hash,
+        "source": [stat.st_size, stat.st_mtime_ns],
+        "created": time.time(),
+    }
+    data = data.replace_schema_metadata(
+        {**(data.schema.metadata or {}), b"aedes": json.dumps(metadata).encode()}
+    )
+
+    tmp_path = f"{snapshot_path}.tmp"
+    feather.write_feather(data, tmp_path, compression="uncompressed")
+    os.replace(tmp_path, snapshot_path)
+
+    if log:
+        logging.info(f"IBGE snapshot written to '{snapshot_path}'...")
+
+
+def get_geography(params, log=False):
+    ibge_file_path = params.get("ibge_file_path") or os.path.join(
+        params["ibge_path"], params["ibge_file_name"]
+    )
+    country = params["country"]
+    use_snapshot = params.get("ibge_snapshot", True)
+
+    stat = os.stat(ibge_file_path)
+    key = (os.path.abspath(ibge_file_path), country)
+    version = (stat.st_size, stat.st_mtime_ns)
+
+    cached = _geography.get(key)
+    if cached is not None and cached[0] == version:
+        get_metrics().inc("geography_cache", result="hit")
+        return cached[1]
+
+    snapshot_path = get_snapshot_path(ibge_file_path)
+    snapshot = (
+        read_snapshot(snapshot_path, ibge_file_path, log=log) if use_snapshot else None
+    )
+
+    if snapshot is not None:
+        if log:
+            logging.info(f"Reading IBGE snapshot at '{snapshot_path}'...")
+
+        df, content_hash = snapshot
+        geography = Geography(df, country, content_hash=content_hash)
+        get_metrics().inc("geography_cache", result="snapshot")
+    else:
+        if log:
+            logging.info(f"Reading IBGE file at '{ibge_file_path}'...")
+
+        content_hash = file_hash(ibge_file_path)
+        geography = Geography(
+            read_geography(ibge_file_path), country, content_hash=content_hash
+        )
+        get_metrics().inc("geography_cache", result="miss")
+
+        if use_snapshot:
+            write_snapshot(
+                geography.df, snapshot_path, ibge_file_path, content_hash, log=log
+            )
+
+    _geography[key] = (version, geography)
+
+    if log:
+        logging.info(f"Geography index of {len(geography)} cities loaded...")
+
+    return geography
+
+
+def geography_expired(ibge_file_path, max_age_days):
+    if not max_age_days:
+        return False
+
+    age = time.time() - os.path.getmtime(ibge_file_path)
+
+    return age > max_age_days * 86400
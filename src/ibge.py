@@ -1,10 +1,15 @@
 import logging
 import os
 from venv import create
-from src.utils import http_response, check_file, check_dir, mask_city, mask_uf
-import pandas as pd
+from src.cache import get_cache
+from src.geography import geography_expired, get_geography
+from src.metrics import instrument
+from src.ratelimit import get_rate_limiter
+from src.shard import select_shard
+from src.utils import http_response, check_file, check_dir
 
 
+@instrument("ibge")
 def process_ibge_data(params, log=False):
     ibge_path = params["ibge_path"]
     ibge_file_name = params["ibge_file_name"]
@@ -18,33 +23,36 @@ def process_ibge_data(params, log=False):
 
     if not check_file(ibge_file_path):
         create_ibge_data(params, log=log)
-
-    if log:
-        logging.info(f"Reading IBGE file at '{ibge_file_path}'...")
-
-    df = pd.read_csv(ibge_file_path)
-
-    if list_uf:
-        mask = mask_uf(df, list_uf, log=log)
-        df = df[mask]
-
-    if list_city:
-        mask = mask_city(df, list_city, log=log)
-        df = df[mask]
+    elif not params.get("ibge_refreshed") and (
+        params.get("ibge_refresh")
+        or geography_expired(ibge_file_path, params.get("ibge_max_age_days"))
+    ):
+        # At most once per run (params), although main.py, the pipeline and
+        # the shard coordinator all call this; a failed refresh keeps using
+        # the current file instead of retrying on every call.
+        params["ibge_refreshed"] = True
+        try:
+            create_ibge_data(params, refresh=True, log=log)
+        except Exception as e:
+            logging.error(f"IBGE refresh failed, keeping '{ibge_file_path}': {e!r}")
+
+    # Parsed once per file; later calls only filter the cached index.
+    geography = get_geography(params, log=log)
+
+    df = geography.select(list_uf, list_city, log=log)
+
+    if params.get("shard"):
+        df = select_shard(df, params, df_all=geography.df, log=log)
 
     return df
 
 
-def create_ibge_data(params, log=False):
+def create_ibge_data(params, refresh=False, log=False):
     country = params["country"]
     url = params["ibge_api"]
     format = params["format"]
     ibge_file_path = params["ibge_file_path"]
 
-    result = http_response(
-        url=url, format=format, max_retries=5, backoff_factor=60, log=log
-    )
-
     columns = [
         "municipio.id",
         "municipio.nome",
@@ -59,6 +67,19 @@ def create_ibge_data(params, log=False):
         "municipio.regiao-imediata.regiao-intermediaria.UF.nome",
         "municipio.regiao-imediata.regiao-intermediaria.UF.regiao.nome",
     ]
+
+    result = http_response(
+        url=url,
+        format=format,
+        max_retries=5,
+        backoff_factor=60,
+        rate_limiter=get_rate_limiter(url, rate=params.get("rate_limit", 10), log=log),
+        # A refresh must reach the API, not a still fresh cached response.
+        cache=None if refresh else get_cache(params, log=log),
+        fields=columns,
+        log=log,
+    )
+
     columns_rename = {
         "municipio.id": "geocode",
         "municipio.nome": "municipio",
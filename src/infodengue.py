@@ -1,6 +1,20 @@
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import numpy as np
 import pandas as pd
+from src.cache import get_cache
+from src.manifest import get_state, open_manifest, stale_requests, update_manifest
+from src.metrics import get_metrics, instrument
+from src.ratelimit import get_rate_limiter
+from src.store import (
+    append_csv,
+    get_store_path,
+    read_store,
+    recover_csv,
+    upsert_frame,
+    write_store,
+)
 from src.utils import get_url_resp, http_response, check_file, check_dir, set_csv_path
 
 
@@ -28,19 +42,26 @@ def df_assign(params, log=False):
     ).sort_values(by=["geocode", "disease"])
 
 
+@instrument("fetch")
 def prepare_api_request(params, log=False):
+    workers = params.get("workers", 1)
+
+    params_request, df = plan_requests(params, log=log)
+
+    run_requests(request_geocode, params_request, df, workers, log=log)
+    return
+
+
+def plan_requests(params, log=False):
     year = params["year"]
     df = params["infodengue_data"]
     ew_start = params["ew_start"]
     ew_end = params["ew_end"]
     format = params["format"]
     url = params["infodengue_api"]
-
-    columns_sort = ["disease", "SE"]
-    columns_ascending = [True, False]
+    workers = params.get("workers", 1)
 
     date = pd.Timestamp.today()
-    df_mew = pd.DataFrame()
 
     weekofyear = check_weekofyear(date, year, log=log)
 
@@ -50,39 +71,215 @@ def prepare_api_request(params, log=False):
         "ew_start": ew_start,
         "ew_end": ew_end,
         "url": url,
-        "columns_sort": columns_sort,
-        "columns_ascending": columns_ascending,
         "weekofyear": weekofyear,
+        "pool_maxsize": max(workers, 10),
+        "rate_limiter": get_rate_limiter(url, rate=params.get("rate_limit", 10), log=log),
+        "cache": get_cache(params, log=log),
+        "country": params["country"],
+        "storage": params.get("storage", "csv"),
+        "store_path": get_store_path(params),
+        "store_max_fragments": params.get("store_max_fragments", 8),
     }
 
     if log:
         logging.info(f"Preparing API request...")
         logging.info(f"Request parameters: {params_request}")
 
-    for index, row in df.iterrows():
-        df = pd.DataFrame()
+    params_request["manifest"] = get_manifest(params, log=log)
+
+    if params_request["manifest"] is not None:
+        df = stale_requests(
+            df,
+            params_request["manifest"],
+            year,
+            weekofyear,
+            ttl=params.get("manifest_ttl"),
+            log=log,
+        )
+
+    return params_request, df
+
+
+@instrument("backfill")
+def backfill_api_request(params, log=False):
+    year_start = params["year_start"]
+    year_end = params["year_end"]
+    df = params["infodengue_data"]
+    url = params["infodengue_api"]
+    workers = params.get("workers", 1)
+
+    date = pd.Timestamp.today()
+
+    params_request = {
+        "year_start": year_start,
+        "year_end": year_end,
+        "format": params["format"],
+        "ew_start": params["ew_start"],
+        "ew_end": params["ew_end"],
+        "url": url,
+        "weekofyear": {
+            year: check_weekofyear(date, year)
+            for year in range(year_start, year_end + 1)
+        },
+        "pool_maxsize": max(workers, 10),
+        "rate_limiter": get_rate_limiter(url, rate=params.get("rate_limit", 10), log=log),
+        "cache": get_cache(params, log=log),
+        "country": params["country"],
+        "storage": params.get("storage", "csv"),
+        "store_path": get_store_path(params),
+        "store_max_fragments": params.get("store_max_fragments", 8),
+    }
+
+    if log:
+        logging.info(f"Preparing backfill API request for {year_start}-{year_end}...")
+
+    params_request["manifest"] = get_manifest(params, log=log)
+
+    if params_request["manifest"] is not None:
+        df = pd.concat(
+            [
+                stale_requests(df, params_request["manifest"], year, weekofyear)
+                for year, weekofyear in params_request["weekofyear"].items()
+            ]
+        ).drop_duplicates(subset=["geocode", "disease"])
+
+    run_requests(backfill_geocode, params_request, df, workers, log=log)
+    return
+
+
+def run_requests(func, params_request, df, workers=1, log=False):
+    # Every disease of a geocode shares the same aedes_data_{year}.csv, so a
+    # geocode is the unit of work: only one worker ever touches a given file.
+    list_rows = [rows for _, rows in df.groupby("csv_path", sort=False)]
+
+    start = time.perf_counter()
+    failed = 0
+
+    if workers > 1:
+        if log:
+            logging.info(f"Requesting API data with {workers} workers...")
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(run_geocode, func, dict(params_request), rows, log): rows
+                for rows in list_rows
+            }
+
+            # Popped as they finish, so results (request_geocode's frames)
+            # are not all kept until the end.
+            for future in as_completed(futures):
+                rows = futures.pop(future)
+                try:
+                    future.result()
+                except Exception as e:
+                    failed += 1
+                    get_metrics().inc("geocodes_failed")
+                    logging.error(f"Geocoding {rows['geocode'].iloc[0]} failed: {e}")
+    else:
+        for rows in list_rows:
+            run_geocode(func, params_request, rows, log=log)
+
+    elapsed = time.perf_counter() - start
+    total = len(df)
+
+    if log:
+        logging.info(
+            f"Requested {total} geocode/disease pairs in {elapsed:.2f}s "
+            f"({total / elapsed if elapsed else 0:.2f} pairs/s, {failed} failed geocodes)..."
+        )
+        if params_request["cache"] is not None:
+            logging.info(f"HTTP cache: {params_request['cache'].stats()}")
+    return
+
+
+def run_geocode(func, params_request, rows, log=False):
+    metrics = get_metrics()
+
+    with metrics.timer("geocode_fetch", geocode=rows["geocode"].iloc[0]):
+        result = func(params_request, rows, log=log)
+
+    metrics.inc("geocodes_fetched")
+
+    return result
+
+
+def get_manifest(params, log=False):
+    manifest_path = params.get("manifest_path")
+
+    if manifest_path:
+        return open_manifest(manifest_path, log=log)
+
+
+def record_state(params_request, df, disease, year):
+    if params_request["manifest"] is None:
+        return
+
+    max_se, gaps = get_state(df, disease, params_request["ew_start"])
+    update_manifest(
+        params_request["manifest"],
+        params_request["geocode"],
+        disease,
+        year,
+        max_se,
+        gaps,
+    )
+
+
+def load_data(params_request, csv_path, year, log=False):
+    if params_request["storage"] == "parquet":
+        return read_store(
+            params_request["store_path"],
+            params_request["country"],
+            params_request["uf"],
+            params_request["geocode"],
+            year=year,
+            log=log,
+        )
+
+    file_path = get_file_path(csv_path, year)
+    recover_csv(file_path, log=log)
+
+    if not check_file(file_path):
+        return pd.DataFrame()
+
+    df = pd.read_csv(file_path)
+    if log:
+        logging.info(f"File '{file_path}' loaded successfully...")
+
+    return df
+
+
+def get_file_path(csv_path, year):
+    return csv_path + "/aedes_data_" + str(year) + ".csv"
+
+
+def request_geocode(params_request, rows, log=False):
+    # Returns the year file's contents after the update, by file path, so
+    # the pipeline can merge them without reading the file back.
+    year = params_request["year"]
+    ew_start = params_request["ew_start"]
+    ew_end = params_request["ew_end"]
+    frames = {}
+
+    for index, row in rows.iterrows():
         csv_path = row["csv_path"]
         geocode = row["geocode"]
         disease = row["disease"]
 
-        file_name = "/aedes_data_" + str(year) + ".csv"
-
-        file_path = csv_path + file_name
+        file_path = get_file_path(csv_path, year)
         check_dir(dir_path=csv_path, log=log)
 
         params_request["geocode"] = geocode
         params_request["disease"] = disease
+        params_request["uf"] = row["mesorregiao_uf"]
         params_request["file_path"] = file_path
+
+        df = load_data(params_request, csv_path, year, log=log)
         params_request["df"] = df
 
-        if not check_file(file_path):
+        if df.empty:
             initial_file(params_request, log=log)
         else:
-            df = pd.read_csv(file_path)
-            params_request["df"] = df
-            if log:
-                logging.info(f"File '{file_path}' loaded successfully...")
-
             df_mew = missing_ew_request(
                 df=df,
                 geocode=geocode,
@@ -95,7 +292,7 @@ def prepare_api_request(params, log=False):
             if not df_mew.empty:
                 if log:
                     logging.info("Requesting data for missing EWs...")
-                params["df_mew"] = df_mew
+                params_request["df_mew"] = df_mew
 
                 request_api_mew(params_request, log=log)
             else:
@@ -103,9 +300,102 @@ def prepare_api_request(params, log=False):
                     logging.info("No EWs to request...")
 
             dynamic_request(params_request, log=log)
+
+        record_state(params_request, params_request["df"], disease, year)
+        frames[file_path] = params_request["df"]
+
+    return frames
+
+
+def backfill_geocode(params_request, rows, log=False):
+    year_start = params_request["year_start"]
+    year_end = params_request["year_end"]
+    ew_start = params_request["ew_start"]
+    ew_end = params_request["ew_end"]
+    csv_path = rows["csv_path"].iloc[0]
+    geocode = rows["geocode"].iloc[0]
+
+    check_dir(dir_path=csv_path, log=log)
+
+    params_request["geocode"] = geocode
+    params_request["uf"] = rows["mesorregiao_uf"].iloc[0]
+
+    dict_df = {
+        year: load_data(params_request, csv_path, year, log=log)
+        for year in range(year_start, year_end + 1)
+    }
+    dict_new = {}
+
+    for disease in rows["disease"]:
+        params_request["disease"] = disease
+
+        list_year = [
+            year
+            for year, df in dict_df.items()
+            if not check_year(
+                df,
+                geocode,
+                disease,
+                ew_start,
+                ew_end,
+                params_request["weekofyear"][year],
+            )
+        ]
+
+        for ey_start, ey_end in contiguous_ranges(list_year):
+            params_request["url_resp"] = get_url_resp(
+                url=params_request["url"],
+                disease=disease,
+                geocode=geocode,
+                format=params_request["format"],
+                ew_start=ew_start,
+                ew_end=ew_end,
+                year=ey_start,
+                ey_end=ey_end,
+            )
+            if log:
+                logging.info(
+                    f"[{disease}] - Requesting data for {ey_start}-{ey_end} {params_request['url_resp']}..."
+                )
+
+            df_api = fetch_api_data(params_request, log=log)
+
+            if df_api.empty:
+                continue
+
+            for year, df_year in df_api.groupby(df_api["SE"] // 100):
+                dict_new.setdefault(year, []).append(df_year)
+
+    for year in sorted(dict_new):
+        if year not in dict_df:
+            logging.warning(
+                f"[{geocode}] - Ignoring {sum(map(len, dict_new[year]))} rows of "
+                f"{year}, outside {year_start}-{year_end}..."
+            )
+            continue
+
+        params_request["df"] = dict_df[year]
+        params_request["file_path"] = get_file_path(csv_path, year)
+        save_api_data(params_request, dict_new[year], log=log)
+        dict_df[year] = params_request["df"]
+
+    for year, df in dict_df.items():
+        for disease in rows["disease"]:
+            record_state(params_request, df, disease, year)
     return
 
 
+def check_year(df, geocode, disease, ew_start, ew_end, weekofyear):
+    if df.empty or disease not in df["disease"].values:
+        return False
+
+    max_se = (df.loc[df["disease"] == disease, "SE"] % 100).max()
+    if max_se < weekofyear - 1:
+        return False
+
+    return missing_ew_request(df, geocode, disease, ew_start, ew_end).empty
+
+
 def check_weekofyear(date, year, log=False):
     if date.year > year:
         if log:
@@ -166,50 +456,63 @@ def missing_ew_request(df, geocode, disease, ew_start, ew_end, log=False):
     return df_mew
 
 
+def contiguous_ranges(values):
+    values = np.sort(np.asarray(values, dtype=int))
+    breaks = np.flatnonzero(np.diff(values) != 1) + 1
+
+    return [(int(v[0]), int(v[-1])) for v in np.split(values, breaks) if v.size]
+
+
 def request_api_mew(params, log=False):
     df = params["df_mew"]
+    list_df = []
 
-    for index, row in df.iterrows():
-        df = pd.read_csv(params["file_path"])
-
-        params["df"] = df
+    for ew_start, ew_end in contiguous_ranges(df["missing_ew"]):
         params["url_resp"] = get_url_resp(
             url=params["url"],
-            disease=row["disease"],
-            geocode=row["geocode"],
+            disease=params["disease"],
+            geocode=params["geocode"],
             format=params["format"],
-            ew_start=row["missing_ew"],
-            ew_end=row["missing_ew"],
+            ew_start=ew_start,
+            ew_end=ew_end,
             year=params["year"],
         )
-
-        request_api_data(params, log=log)
         if log:
             logging.info(
-                f"[{row['disease']}] - Requesting data for EW {row['missing_ew']} {params['url_resp']}..."
+                f"[{params['disease']}] - Requesting data for EWs {ew_start}-{ew_end} {params['url_resp']}..."
             )
 
+        list_df.append(fetch_api_data(params, log=log))
+
+    save_api_data(params, list_df, log=log)
     return
 
 
 def request_api_data(params, log=False):
+    return save_api_data(params, [fetch_api_data(params, log=log)], log=log)
+
+
+def fetch_api_data(params, log=False):
     disease = params["disease"]
     geocode = params["geocode"]
     url_resp = params["url_resp"]
     format = params["format"]
-    df = params["df"]
-    file_path = params["file_path"]
-    columns_sort = params["columns_sort"]
-    columns_ascending = params["columns_ascending"]
 
     df_api = http_response(
-        url_resp, format=format, max_retries=3, backoff_factor=60, log=log
+        url_resp,
+        format=format,
+        max_retries=3,
+        backoff_factor=60,
+        pool_maxsize=params["pool_maxsize"],
+        rate_limiter=params["rate_limiter"],
+        cache=params["cache"],
+        log=log,
     )
 
     if df_api.empty:
         if log:
             logging.info(f"Geocoding {geocode} for {disease} has no new data...")
-        return
+        return df_api
     else:
         if log:
             logging.info(f"Geocoding {geocode} for {disease} has new data...")
@@ -221,12 +524,36 @@ def request_api_data(params, log=False):
     df_api["disease"] = disease
     df_api["geocode"] = geocode
 
+    return df_api[columns_api]
+
+
+def save_api_data(params, list_df, log=False):
+    df = params["df"]
+    file_path = params["file_path"]
+
+    list_df = [df_api for df_api in list_df if not df_api.empty]
+
+    if not list_df:
+        return
+
+    df_new = pd.concat(list_df, ignore_index=True)
+
+    if params["storage"] == "parquet":
+        write_store(
+            params["store_path"],
+            df_new,
+            params["country"],
+            params["uf"],
+            max_fragments=params.get("store_max_fragments"),
+            log=log,
+        )
+        params["df"] = upsert_frame(df, df_new)
+        return True
+
     if log:
         logging.info(f"Processing file '{file_path}'...")
 
-    pd.concat([df, df_api[columns_api]], ignore_index=True).sort_values(
-        columns_sort, ascending=columns_ascending
-    ).dropna(axis=1).to_csv(file_path, index=False)
+    params["df"] = append_csv(file_path, df, df_new, log=log)
 
     if log:
         logging.info(f"File '{file_path}' updated successfully...")
@@ -234,8 +561,7 @@ def request_api_data(params, log=False):
 
 
 def dynamic_request(params, log=False):
-
-    df = pd.read_csv(params["file_path"])
+    df = params["df"]
     ew_start = params["ew_start"]
     weekofyear = params["weekofyear"] - 1
     disease = params["disease"]
@@ -0,0 +1,100 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import pandas as pd
+from src.utils import check_dir
+
+
+_manifest_lock = threading.Lock()
+
+
+def open_manifest(manifest_path, log=False):
+    check_dir(os.path.dirname(manifest_path), log=log)
+
+    if log:
+        logging.info(f"Opening fetch-state manifest at '{manifest_path}'...")
+
+    conn = sqlite3.connect(manifest_path, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS fetch_state (
+            geocode INTEGER NOT NULL,
+            disease TEXT NOT NULL,
+            year INTEGER NOT NULL,
+            max_se INTEGER NOT NULL,
+            gaps TEXT NOT NULL,
+            fetched_at TEXT NOT NULL,
+            PRIMARY KEY (geocode, disease, year)
+        )
+        """
+    )
+    conn.commit()
+
+    return conn
+
+
+def read_manifest(conn, year):
+    with _manifest_lock:
+        return pd.read_sql_query(
+            "SELECT * FROM fetch_state WHERE year = ?", conn, params=(year,)
+        )
+
+
+def stale_requests(df, conn, year, weekofyear, ttl=None, log=False):
+    df_manifest = read_manifest(conn, year)
+
+    df_state = df.merge(
+        df_manifest[["geocode", "disease", "max_se", "gaps", "fetched_at"]],
+        on=["geocode", "disease"],
+        how="left",
+    )
+
+    mask_fresh = (df_state["max_se"] >= weekofyear - 1) & (df_state["gaps"] == "[]")
+
+    if ttl is not None:
+        fetched_at = pd.to_datetime(df_state["fetched_at"])
+        mask_fresh &= fetched_at >= pd.Timestamp.now() - pd.Timedelta(ttl)
+
+    mask_fresh = mask_fresh.to_numpy()
+
+    if log:
+        logging.info(
+            f"Manifest: {mask_fresh.sum()} geocode/disease pairs up to date, "
+            f"{(~mask_fresh).sum()} to request..."
+        )
+
+    return df[~mask_fresh]
+
+
+def get_state(df, disease, ew_start):
+    if df.empty or "disease" not in df.columns:
+        return 0, []
+
+    se = df.loc[df["disease"] == disease, "SE"] % 100
+    if se.empty:
+        return 0, []
+
+    max_se = int(se.max())
+    gaps = sorted(set(range(ew_start, max_se + 1)) - set(se.tolist()))
+
+    return max_se, gaps
+
+
+def update_manifest(conn, geocode, disease, year, max_se, gaps):
+    with _manifest_lock:
+        conn.execute(
+            "INSERT OR REPLACE INTO fetch_state VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                int(geocode),
+                disease,
+                int(year),
+                int(max_se),
+                json.dumps([int(ew) for ew in gaps]),
+                pd.Timestamp.now().isoformat(),
+            ),
+        )
+        conn.commit()
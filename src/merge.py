@@ -1,125 +1,357 @@
+import hashlib
+import json
 import logging
 import os
+import re
+import time
+import unicodedata
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from src.metrics import get_metrics, instrument, record_write, reset_metrics
+from src.schema import (
+    FACT_COLUMNS,
+    OUTPUT_VERSION,
+    apply_output_schema,
+    concat_frames,
+)
+from src.star import get_country_path, get_fact_path, write_dimension
+from src.store import get_store_path, read_fragments, recover_csv, store_files
 from src.utils import check_dir, check_file, set_csv_path
 
 
+@instrument("merge_city")
 def merge_city(params, log=False):
-    infodengue_file_name = params["infodengue_file_name"]
+    workers = params.get("merge_workers", 1)
 
     df = params["ibge_data"].sort_values(by=["mesorregiao_uf", "municipio"])
 
     df["csv_path"] = set_csv_path(params, log=log)
 
-    for index, row in df.iterrows():
-        city_path = row["csv_path"]
-        list_df = []
-        df_city = pd.DataFrame()
+    params_merge = get_params_merge(params)
 
+    list_row = [row for index, row in df.iterrows()]
+    start = time.perf_counter()
+
+    if workers > 1:
         if log:
-            logging.info(
-                f"{row['municipio']} ({row['mesorregiao_uf']}) - Merging city data..."
+            logging.info(f"Merging city data with {workers} processes...")
+
+        with ProcessPoolExecutor(
+            max_workers=workers, initializer=reset_metrics
+        ) as executor:
+            list_result = list(
+                executor.map(
+                    merge_one_city,
+                    repeat(params_merge),
+                    list_row,
+                    repeat(log),
+                    chunksize=max(1, len(list_row) // (workers * 8)),
+                )
             )
+    else:
+        list_result = [merge_one_city(params_merge, row, log=log) for row in list_row]
+
+    for *_, snapshot in list_result:
+        get_metrics().update(snapshot)
+
+    list_result = [result[:3] for result in list_result]
+
+    list_dirty = {uf for status, uf, _ in list_result if status == "merged"}
+    params["dirty_uf"] = list_dirty
+    params["dirty_city"] = {
+        row["geocode"]
+        for row, (status, uf, _) in zip(list_row, list_result)
+        if status == "merged"
+    }
+
+    if log:
+        elapsed = time.perf_counter() - start
+        summary = {
+            status: sum(1 for result in list_result if result[0] == status)
+            for status in ["merged", "skipped", "empty", "failed"]
+        }
+        logging.info(f"City merge done in {elapsed:.2f}s: {summary}")
+        logging.info(f"UFs with changed cities: {sorted(list_dirty)}")
+
+    for status, uf, message in list_result:
+        if status == "failed":
+            logging.error(message)
 
+    return list_dirty
+
+
+def get_params_merge(params):
+    return {
+        "country": params["country"],
+        "infodengue_file_name": params["infodengue_file_name"],
+        "storage": params.get("storage", "csv"),
+        "store_path": get_store_path(params),
+        "merge_fingerprint": params.get("merge_fingerprint", "stat"),
+        "output_layout": params.get("output_layout", "wide"),
+    }
+
+
+def merge_one_city(params_merge, row, log=False, return_data=False, frames=None):
+    # May run in a worker process, so the city's metrics are drained and
+    # shipped back with its result. With return_data, the merged rows come
+    # back too, as an Arrow table (None unless the city was merged).
+    # `frames` maps raw CSV paths to their contents, when already in memory.
+    metrics = get_metrics()
+
+    with metrics.timer("geocode_merge", geocode=row["geocode"]):
+        status, uf, message, table = merge_city_files(
+            params_merge, row, frames=frames, log=log
+        )
+
+    metrics.inc("cities", status=status)
+
+    if not return_data:
+        return status, uf, message, metrics.drain()
+
+    return status, uf, message, table, metrics.drain()
+
+
+def merge_city_files(params_merge, row, frames=None, log=False):
+    infodengue_file_name = params_merge["infodengue_file_name"]
+    city_path = row["csv_path"]
+    city = f"{row['municipio']} ({row['mesorregiao_uf']})"
+
+    try:
         check_dir(dir_path=city_path, log=log)
 
-        for file in os.listdir(city_path):
-            city_file = os.path.join(city_path, file)
-            file = f"{infodengue_file_name}.parquet"
-            file_path = os.path.join(city_path, file)
+        file_path = os.path.join(city_path, f"{infodengue_file_name}.parquet")
+        state_path = os.path.join(city_path, "_merge_state.json")
 
-            if city_file.endswith(".csv") and check_file(city_file):
-                list_df.append(pd.read_csv(city_file))
+        list_file = source_files(params_merge, row)
+        fingerprint = get_fingerprint(
+            list_file,
+            row,
+            method=params_merge["merge_fingerprint"],
+            layout=params_merge["output_layout"],
+        )
 
-        if list_df:
-            add_columns_and_save(list_df, file_path, row, log=log)
+        if check_file(file_path, type="parquet") and (
+            read_fingerprint(state_path) == fingerprint
+        ):
+            if log:
+                logging.info(f"{city} - Unchanged, skipping...")
+            return "skipped", row["mesorregiao_uf"], None, None
+
+        if log:
+            logging.info(f"{city} - Merging city data...")
 
+        if params_merge["storage"] == "parquet":
+            list_df = (
+                [read_fragments(params_merge["store_path"], list_file)]
+                if list_file
+                else []
+            )
         else:
+            frames = frames or {}
+            list_df = [
+                frames[city_file] if city_file in frames else pd.read_csv(city_file)
+                for city_file in list_file
+            ]
+
+        if not list_df:
             if log:
-                logging.info(
-                    f"{row['municipio']} ({row['mesorregiao_uf']}) - No data found!"
-                )
+                logging.info(f"{city} - No data found!")
+            return "empty", row["mesorregiao_uf"], None, None
+
+        table = add_columns_and_save(
+            list_df, file_path, row, layout=params_merge["output_layout"], log=log
+        )
+        write_fingerprint(state_path, fingerprint)
+
+        return "merged", row["mesorregiao_uf"], None, table
+
+    except Exception as e:
+        return "failed", row["mesorregiao_uf"], f"{city} - Merge failed: {e!r}", None
+
+
+def source_files(params_merge, row):
+    if params_merge["storage"] == "parquet":
+        return store_files(
+            params_merge["store_path"],
+            params_merge["country"],
+            row["mesorregiao_uf"],
+            row["geocode"],
+        )
+
+    city_path = row["csv_path"]
+    list_file = sorted(
+        os.path.join(city_path, file)
+        for file in os.listdir(city_path)
+        if file.endswith(".csv")
+    )
+
+    for city_file in list_file:
+        recover_csv(city_file)
+
+    return [city_file for city_file in list_file if check_file(city_file)]
+
+
+def get_fingerprint(list_file, row, method="stat", layout="wide"):
+    # Identifies a city's inputs: its IBGE attributes plus size/mtime (or a
+    # content hash with method="hash") of every raw file that feeds it.
+    fingerprint = {
+        "ibge": row.drop(labels=["csv_path"]).astype(str).to_dict(),
+        "layout": layout,
+        "output_version": OUTPUT_VERSION,
+        "files": {},
+    }
+
+    for file in list_file:
+        if method == "hash":
+            with open(file, "rb") as f:
+                fingerprint["files"][file] = hashlib.sha256(f.read()).hexdigest()
+        else:
+            stat = os.stat(file)
+            fingerprint["files"][file] = [stat.st_size, stat.st_mtime_ns]
+
+    return fingerprint
+
+
+def read_fingerprint(state_path):
+    if not os.path.exists(state_path):
+        return None
+
+    with open(state_path, "r") as f:
+        return json.load(f)
+
+
+def write_fingerprint(state_path, fingerprint):
+    with open(f"{state_path}.tmp", "w") as f:
+        json.dump(fingerprint, f)
+    os.replace(f"{state_path}.tmp", state_path)
+
+
+def get_output_fingerprint(list_file, **attrs):
+    # Identifies a UF or country output by the size/mtime of the files it was
+    # built from, so a run that stopped after merging a city but before its
+    # UF still leaves that UF (and the country) to be rebuilt by the next.
+    fingerprint = {**attrs, "files": {}}
+
+    for file in list_file:
+        stat = os.stat(file)
+        fingerprint["files"][file] = [stat.st_size, stat.st_mtime_ns]
+
+    return fingerprint
+
+
+def get_state_path(file_path):
+    name = os.path.splitext(os.path.basename(file_path))[0]
+    return os.path.join(os.path.dirname(file_path), f"_merge_state_{name}.json")
+
+
+def output_unchanged(file_path, fingerprint):
+    return check_file(file_path, type="parquet") and (
+        read_fingerprint(get_state_path(file_path)) == fingerprint
+    )
+
+
+RECEPTIVO = [
+    "desfavorável",
+    "favorável",
+    "favorável nesta semana e na semana passada",
+    "favorável por pelo menos três semanas",
+]
+
+TRANSMISSAO = [
+    "nenhuma evidência",
+    "possível",
+    "provável",
+    "altamente provável",
+]
+
+NIVEL_INC = [
+    "Incidência estimada abaixo do limiar pré-epidemia",
+    "acima do limiar pré-epidemia, mas abaixo do limiar epidêmico",
+    "acima do limiar epidêmico",
+]
+
+INT_COLUMNS = [
+    "casos_est",
+    "casos_est_min",
+    "casos_est_max",
+    "casos",
+    "pop",
+    "notif_accum_year",
+]
+
+ROUND_COLUMNS = {
+    "p_rt1": 2,
+    "p_inc100k": 4,
+    "Rt": 2,
+    "tempmin": 2,
+    "tempmed": 2,
+    "tempmax": 2,
+    "umidmin": 2,
+    "umidmed": 2,
+    "umidmax": 2,
+}
 
 
 def transform_columns(df, log=False):
     df["tweet"] = 0
     df = drop_columns(df, log=log)
 
-    columns = [
-        "casos_est",
-        "casos_est_min",
-        "casos_est_max",
-        "casos",
-        "pop",
-        "notif_accum_year",
-    ]
-    if log:
-        logging.info(f"Casting columns {columns}...")
-    df[columns] = df[columns].fillna(0).astype(int)
-
-    columns = ["p_rt1", "p_inc100k", "Rt", "tempmin", "tempmed", "tempmax"]
     if log:
-        logging.info(f"Rounding columns {columns}...")
-
-    df = df.round(
-        {
-            "p_rt1": 2,
-            "p_inc100k": 4,
-            "Rt": 2,
-            "tempmin": 2,
-            "tempmed": 2,
-            "tempmax": 2,
-            "umidmin": 2,
-            "umidmed": 2,
-            "umidmax": 2,
-        }
+        logging.info(f"Casting columns {INT_COLUMNS}...")
+        logging.info(f"Rounding columns {list(ROUND_COLUMNS)}...")
+        logging.info(f"Adding columns ['year', 'receptivo', 'transmissao', 'nivel_inc']...")
+
+    return df.assign(
+        **{column: df[column].fillna(0).astype(int) for column in INT_COLUMNS},
+        **{
+            column: df[column].round(decimals)
+            for column, decimals in ROUND_COLUMNS.items()
+            if column in df.columns
+        },
+        receptivo=map_codes(df["receptivo"], RECEPTIVO),
+        transmissao=map_codes(df["transmissao"].fillna(0), TRANSMISSAO),
+        nivel_inc=map_codes(df["nivel_inc"], NIVEL_INC),
+        year=df["SE"] // 100,
+        SE=df["SE"] % 100,
     )
 
-    columns = ["year", "week", "receptivo", "transmissao", "nivel_inc"]
 
-    if log:
-        logging.info(f"Adding columns {columns}...")
+def map_codes(series, labels):
+    # Codes outside 0..len(labels)-1 (or missing) map to the extra "Invalid"
+    # category, matching the scalar data_* helpers.
+    values = pd.to_numeric(series, errors="coerce").to_numpy(dtype=float)
 
-    df["receptivo"] = df["receptivo"].apply(data_receptivo)
-    df["transmissao"] = df["transmissao"].fillna(0).apply(data_transmissao)
-    df["nivel_inc"] = df["nivel_inc"].apply(data_nivel_inc)
+    valid = (values >= 0) & (values < len(labels)) & (values == np.floor(values))
+    codes = np.full(len(values), len(labels), dtype=np.int8)
+    codes[valid] = values[valid]
 
-    df["year"] = df["SE"] // 100
-    df["SE"] = df["SE"] % 100
+    return pd.Categorical.from_codes(
+        codes, categories=[*labels, "Invalid"]
+    )
 
-    return df
 
+def data_code(value, labels):
+    if value in range(len(labels)):
+        return labels[int(value)]
 
-def data_receptivo(value):
-    switcher = {
-        0: "desfavorável",
-        1: "favorável",
-        2: "favorável nesta semana e na semana passada",
-        3: "favorável por pelo menos três semanas",
-    }
+    return "Invalid"
 
-    return switcher.get(value, "Invalid")
 
+def data_receptivo(value):
+    return data_code(value, RECEPTIVO)
 
-def data_transmissao(value):
-    switcher = {
-        0: "nenhuma evidência",
-        1: "possível",
-        2: "provável",
-        3: "altamente provável",
-    }
 
-    return switcher.get(value, "Invalid")
+def data_transmissao(value):
+    return data_code(value, TRANSMISSAO)
 
 
 def data_nivel_inc(value):
-    switcher = {
-        0: "Incidência estimada abaixo do limiar pré-epidemia",
-        1: "acima do limiar pré-epidemia, mas abaixo do limiar epidêmico",
-        2: "acima do limiar epidêmico",
-    }
-
-    return switcher.get(value, "Invalid")
+    return data_code(value, NIVEL_INC)
 
 
 def drop_columns(df, log=False):
@@ -134,8 +366,25 @@ def drop_columns(df, log=False):
     return df
 
 
-def add_columns_and_save(list_df, file_path, row, log=False):
-    df = transform_columns(create_df(list_df), log=log)
+def add_columns_and_save(list_df, file_path, row, layout="wide", log=False):
+    with get_metrics().timer("transform"):
+        df = transform_columns(create_df(list_df), log=log)
+
+    if layout == "star":
+        table = pa.Table.from_pandas(
+            apply_output_schema(df, columns=FACT_COLUMNS).sort_values(
+                by=["disease", "year", "SE"], ascending=[True, False, False]
+            ),
+            preserve_index=False,
+        )
+        pq.write_table(table, file_path)
+        record_write(file_path, table.num_rows, target="city")
+
+        if log:
+            logging.info(
+                f"{row['municipio']} ({row['mesorregiao_uf']}) - Merging done!"
+            )
+        return table
 
     df["country"] = row["country"]
     df["municipio"] = row["municipio"]
@@ -152,20 +401,35 @@ def add_columns_and_save(list_df, file_path, row, log=False):
         "regiao_intermediaria_uf_regiao_nome"
     ]
 
-    df.sort_values(
-        by=["disease", "year", "SE"], ascending=[True, False, False]
-    ).to_parquet(
-        file_path,
-        index=False,
+    # Converted once: the same table is written here and, in merge_hierarchy,
+    # handed on to the UF and country writers.
+    table = pa.Table.from_pandas(
+        apply_output_schema(df).sort_values(
+            by=["disease", "year", "SE"], ascending=[True, False, False]
+        ),
+        preserve_index=False,
     )
+    pq.write_table(table, file_path)
+    record_write(file_path, table.num_rows, target="city")
 
     if log:
         logging.info(f"{row['municipio']} ({row['mesorregiao_uf']}) - Merging done!")
 
+    return table
+
 
+@instrument("merge_uf")
 def merge_uf(params, log=False):
     infodengue_file_name = params["infodengue_file_name"]
-    df = merge_df(params, uf=True, log=log).sort_values(by=["mesorregiao_uf"])
+
+    if params.get("output_layout", "wide") == "star":
+        if log:
+            logging.info(f"Star layout: UF data is a view over the country facts...")
+        return
+
+    df = merge_df(params, uf=True, log=log).sort_values(
+        by=["mesorregiao_uf", "geocode"]
+    )
 
     if log:
         logging.info(f"Merging UF data...")
@@ -174,41 +438,56 @@ def merge_uf(params, log=False):
 
     if list_uf:
         for uf in list_uf:
-            if log:
-                logging.info(f"Merging UF [{uf}] data...")
-
             mask = df["mesorregiao_uf"] == uf
             df_uf = df[mask].reset_index(drop=True)
 
-            uf_path = df_uf["uf_path"][0]
-            uf_file = f"{infodengue_file_name}_{uf.lower()}.parquet"
-            file_name = f"{infodengue_file_name}.parquet"
+            merge_one_uf(infodengue_file_name, uf, df_uf, log=log)
+    else:
+        if log:
+            logging.info(f"No UF data found!")
 
-            list_city = []
 
-            for index, row in df_uf.iterrows():
-                file_path = os.path.join(row["csv_path"], file_name)
+def merge_one_uf(infodengue_file_name, uf, df_uf, log=False):
+    # `df_uf` lists the UF's cities (csv_path, uf_path) in geocode order.
+    # Returns whether the UF file was rewritten.
+    uf_path = df_uf["uf_path"].iloc[0]
+    uf_file_path = os.path.join(uf_path, f"{infodengue_file_name}_{uf.lower()}.parquet")
+    file_name = f"{infodengue_file_name}.parquet"
 
-                if check_file(file_path, type="parquet"):
-                    list_city.append(pd.read_parquet(file_path))
+    list_city = [
+        os.path.join(csv_path, file_name)
+        for csv_path in df_uf["csv_path"]
+        if check_file(os.path.join(csv_path, file_name), type="parquet")
+    ]
 
-            df_city = create_df(list_city).sort_values(
-                by=["geocode", "disease", "year", "SE"],
-                ascending=[True, True, False, False],
-            )
-            df_city.to_parquet(
-                os.path.join(uf_path, uf_file),
-                index=False,
-            )
-            if log:
-                logging.info(f"Merging UF {uf} data done!")
-    else:
+    if not list_city:
+        return False
+
+    fingerprint = get_output_fingerprint(list_city, levels=[])
+    if output_unchanged(uf_file_path, fingerprint):
         if log:
-            logging.info(f"No UF data found!")
+            logging.info(f"UF [{uf}] unchanged, skipping...")
+        return False
+
+    if log:
+        logging.info(f"Merging UF [{uf}] data...")
+
+    stream_merge(list_city, uf_file_path, log=log)
+    write_fingerprint(get_state_path(uf_file_path), fingerprint)
+
+    if log:
+        logging.info(f"Merging UF {uf} data done!")
+
+    return True
 
 
+@instrument("merge_country")
 def merge_country(params, log=False):
     infodengue_file_name = params["infodengue_file_name"]
+
+    if params.get("output_layout", "wide") == "star":
+        return merge_country_star(params, log=log)
+
     country = params["country"]
     df = merge_df(params, country=True, uf=True, log=log)
     df = df[["mesorregiao_uf", "uf_path", "country_path"]]
@@ -228,15 +507,17 @@ def merge_country(params, log=False):
         uf_file_path = os.path.join(row["uf_path"], uf_file)
 
         if check_file(uf_file_path, type="parquet"):
-            list_uf.append(pd.read_parquet(uf_file_path))
+            list_uf.append(uf_file_path)
 
-    if list_uf:
-        df_country = create_df(list_uf).sort_values(
-            by=["mesorregiao_uf", "geocode", "disease", "year", "SE"],
-            ascending=[True, True, True, False, False],
-        )
+    fingerprint = get_output_fingerprint(list_uf)
+    if list_uf and output_unchanged(country_file_path, fingerprint):
+        if log:
+            logging.info(f"Country data unchanged, skipping...")
+        return
 
-        df_country.to_parquet(country_file_path, index=False)
+    if list_uf:
+        stream_merge(list_uf, country_file_path, log=log)
+        write_fingerprint(get_state_path(country_file_path), fingerprint)
 
         if log:
             logging.info(f"Merging country data done!")
@@ -245,6 +526,496 @@ def merge_country(params, log=False):
             logging.info(f"No country data found!")
 
 
+def merge_country_star(params, log=False):
+    infodengue_file_name = params["infodengue_file_name"]
+    df = merge_df(params, country=True, log=log).sort_values(by=["geocode"])
+
+    file_name = f"{infodengue_file_name}.parquet"
+
+    write_dimension(params, log=log)
+
+    fact_file_path = get_fact_path(params)
+    list_city = []
+
+    for index, row in df.iterrows():
+        file_path = os.path.join(row["csv_path"], file_name)
+
+        if check_file(file_path, type="parquet"):
+            list_city.append(file_path)
+
+    fingerprint = get_output_fingerprint(list_city)
+    if list_city and output_unchanged(fact_file_path, fingerprint):
+        if log:
+            logging.info(f"Country facts unchanged, skipping...")
+        return
+
+    if log:
+        logging.info(f"Merging country facts...")
+
+    if list_city:
+        stream_merge(list_city, fact_file_path, log=log)
+        write_fingerprint(get_state_path(fact_file_path), fingerprint)
+
+        if log:
+            logging.info(f"Country facts written to '{fact_file_path}'...")
+    else:
+        if log:
+            logging.info(f"No country data found!")
+
+
+MERGE_LEVELS = [
+    "microrregiao",
+    "mesorregiao",
+    "regiao_imediata",
+    "regiao_intermediaria",
+]
+
+
+@instrument("merge_hierarchy")
+def merge_hierarchy(params, log=False):
+    # merge_city, merge_uf and merge_country in one pass: each merged city is
+    # transformed once and its rows go straight to the UF and country writers
+    # (and one file per region of every `merge_levels` level) instead of
+    # being read back from the files one level below. Unchanged cities and
+    # UFs are only read when a file above them has to be rebuilt.
+    if params.get("output_layout", "wide") == "star":
+        # No UF files: the country facts already stream from the city files.
+        merge_city(params=params, log=log)
+        merge_country(params=params, log=log)
+        return params["dirty_uf"]
+
+    workers = params.get("merge_workers", 1)
+    levels = params.get("merge_levels") or []
+
+    unknown = sorted(set(levels) - set(MERGE_LEVELS))
+    if unknown:
+        raise ValueError(f"Unsupported merge_levels {unknown}, expected {MERGE_LEVELS}")
+
+    df = params["ibge_data"].sort_values(by=["mesorregiao_uf", "geocode"])
+    df["csv_path"] = set_csv_path(params, log=log)
+
+    params_merge = get_params_merge(params)
+    list_row = [row for index, row in df.iterrows()]
+    start = time.perf_counter()
+
+    if log:
+        logging.info(
+            f"Merging city, UF and country data in one pass with {workers} "
+            f"processes, levels {levels}..."
+        )
+
+    writer = HierarchyWriter(params, df, levels=levels, log=log)
+    list_result = []
+
+    try:
+        for row, (status, uf, message, table) in merge_cities_ordered(
+            params_merge, list_row, workers, log=log
+        ):
+            list_result.append((row["geocode"], status, uf, message))
+            writer.add_city(row, status, table)
+
+        writer.close()
+    except BaseException:
+        writer.abort()
+        raise
+
+    list_dirty = {uf for _, status, uf, _ in list_result if status == "merged"}
+    params["dirty_uf"] = list_dirty
+    params["dirty_city"] = {
+        geocode for geocode, status, _, _ in list_result if status == "merged"
+    }
+
+    if log:
+        elapsed = time.perf_counter() - start
+        summary = {
+            status: sum(1 for result in list_result if result[1] == status)
+            for status in ["merged", "skipped", "empty", "failed"]
+        }
+        logging.info(f"Hierarchy merge done in {elapsed:.2f}s: {summary}")
+        logging.info(f"UFs with changed cities: {sorted(list_dirty)}")
+
+    for _, status, uf, message in list_result:
+        if status == "failed":
+            logging.error(message)
+
+    return list_dirty
+
+
+def merge_cities_ordered(params_merge, list_row, workers, log=False):
+    # Yields (row, result) in `list_row` order. At most 2 x workers cities are
+    # in flight, so finished tables never pile up behind a slow city.
+    metrics = get_metrics()
+
+    if workers <= 1:
+        for row in list_row:
+            *result, snapshot = merge_one_city(
+                params_merge, row, log=log, return_data=True
+            )
+            metrics.update(snapshot)
+            yield row, result
+        return
+
+    def collect(row, future):
+        *result, snapshot = future.result()
+        metrics.update(snapshot)
+        return row, result
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=reset_metrics) as executor:
+        pending = deque()
+
+        for row in list_row:
+            future = executor.submit(merge_one_city, params_merge, row, log, True)
+            pending.append((row, future))
+
+            if len(pending) >= workers * 2:
+                yield collect(*pending.popleft())
+
+        while pending:
+            yield collect(*pending.popleft())
+
+
+# Fan-out of city tables (in UF, geocode order) to the UF, region and country
+# files. A UF is rebuilt once one of its cities was merged, one of its files
+# is missing or its saved fingerprint no longer matches its city files; the
+# country once any UF was or its own fingerprint does not match. Until then
+# the unchanged cities and UF files are only remembered, and read if a
+# rebuild follows. `df` lists every city (csv_path) that may arrive.
+class HierarchyWriter:
+    def __init__(self, params, df, levels=(), row_group_size=100_000, log=False):
+        self.infodengue_file_name = params["infodengue_file_name"]
+        self.file_name = f"{self.infodengue_file_name}.parquet"
+        self.dict_city = {
+            uf: df_uf["csv_path"].tolist()
+            for uf, df_uf in df.groupby("mesorregiao_uf", observed=True, sort=False)
+        }
+        self.levels = list(levels)
+        self.row_group_size = row_group_size
+        self.log = log
+
+        country = params["country"].lower()
+        self.country_file_path = os.path.join(
+            get_country_path(params), f"{self.infodengue_file_name}_{country}.parquet"
+        )
+        self.country = None
+        self.country_pending = []
+        self.country_files = []
+
+        self.uf = None
+        self.uf_writers = None
+        self.uf_pending = []
+
+    def add_city(self, row, status, table):
+        if row["mesorregiao_uf"] != self.uf:
+            self.finish_uf()
+            self.start_uf(row)
+
+        if status == "merged" and self.uf_writers is None:
+            self.open_uf()
+
+        if self.uf_writers is None:
+            self.uf_pending.append(row)
+        else:
+            self.write_city(row, table)
+
+    def start_uf(self, row):
+        self.uf = row["mesorregiao_uf"]
+        self.uf_path = os.path.dirname(row["csv_path"])
+        self.uf_file_path = os.path.join(
+            self.uf_path, f"{self.infodengue_file_name}_{self.uf.lower()}.parquet"
+        )
+        self.uf_writers = None
+        self.uf_pending = []
+
+        if not output_unchanged(self.uf_file_path, self.uf_fingerprint()) or any(
+            not os.path.isdir(os.path.join(self.uf_path, level))
+            for level in self.levels
+        ):
+            self.open_uf()
+
+    def uf_fingerprint(self):
+        list_file = [
+            os.path.join(csv_path, self.file_name)
+            for csv_path in self.dict_city[self.uf]
+            if check_file(os.path.join(csv_path, self.file_name), type="parquet")
+        ]
+
+        return get_output_fingerprint(list_file, levels=self.levels)
+
+    def open_uf(self):
+        self.open_country()
+
+        # The country file takes the UF file's row groups as they are written,
+        # the same groups merge_country would read back from it.
+        self.uf_writers = {
+            None: StreamWriter(
+                self.uf_file_path,
+                row_group_size=self.row_group_size,
+                target="uf",
+                downstream=[self.country],
+            )
+        }
+
+        for row in self.uf_pending:
+            self.write_city(row, None)
+        self.uf_pending = []
+
+    def open_country(self):
+        if self.country is not None:
+            return
+
+        self.country = StreamWriter(
+            self.country_file_path, row_group_size=self.row_group_size, target="country"
+        )
+
+        for uf_file_path in self.country_pending:
+            self.country.write_file(uf_file_path)
+        self.country_pending = []
+
+    def write_city(self, row, table):
+        if table is None:
+            file_path = os.path.join(
+                row["csv_path"], f"{self.infodengue_file_name}.parquet"
+            )
+            if not check_file(file_path, type="parquet"):
+                return
+            table = pq.read_table(file_path)
+
+        # Conformed once; the region writers below share its schema.
+        table = self.uf_writers[None].write(table)
+
+        for level in self.levels:
+            key = (level, row[level])
+
+            if key not in self.uf_writers:
+                file_name = f"{self.infodengue_file_name}_{get_region_slug(row[level])}"
+                self.uf_writers[key] = StreamWriter(
+                    os.path.join(self.uf_path, level, f"{file_name}.parquet"),
+                    row_group_size=self.row_group_size,
+                    target=level,
+                )
+
+            self.uf_writers[key].write(table)
+
+    def finish_uf(self):
+        if self.uf is None:
+            return
+
+        if self.uf_writers is not None:
+            rows = self.uf_writers[None].close()
+            for key, writer in self.uf_writers.items():
+                if key is not None:
+                    writer.close()
+
+            if rows:
+                write_fingerprint(
+                    get_state_path(self.uf_file_path), self.uf_fingerprint()
+                )
+
+            if self.log:
+                logging.info(f"UF [{self.uf}] written: {rows} rows...")
+        else:
+            if self.country is not None:
+                self.country.write_file(self.uf_file_path)
+            else:
+                self.country_pending.append(self.uf_file_path)
+
+            if self.log:
+                logging.info(f"UF [{self.uf}] unchanged, skipping...")
+
+        if check_file(self.uf_file_path, type="parquet"):
+            self.country_files.append(self.uf_file_path)
+
+        self.uf = None
+        self.uf_writers = None
+
+    def close(self):
+        self.finish_uf()
+
+        fingerprint = get_output_fingerprint(self.country_files)
+
+        if self.country is None and self.country_pending:
+            if not output_unchanged(self.country_file_path, fingerprint):
+                self.open_country()
+
+        if self.country is not None:
+            rows = self.country.close()
+            if rows:
+                write_fingerprint(get_state_path(self.country_file_path), fingerprint)
+
+            if self.log:
+                logging.info(f"Country data written: {rows} rows...")
+        elif self.log:
+            logging.info(f"Country data unchanged, skipping...")
+
+    def abort(self):
+        for writer in (self.uf_writers or {}).values():
+            writer.abort()
+
+        if self.country is not None:
+            self.country.abort()
+
+
+def get_region_slug(name):
+    text = unicodedata.normalize("NFKD", str(name)).encode("ascii", "ignore")
+    return re.sub(r"[^a-z0-9]+", "_", text.decode().lower()).strip("_")
+
+
+def stream_merge(list_file, file_path, row_group_size=100_000, log=False):
+    # Inputs are already sorted and ordered by the output sort key (one
+    # geocode per city file, one UF per UF file), so the k-way merge reduces
+    # to appending their row groups in order. Only `row_group_size` rows are
+    # buffered at a time, whatever the total size of the inputs.
+    writer = StreamWriter(
+        file_path, schema=merge_schema(list_file), row_group_size=row_group_size
+    )
+
+    try:
+        for input_path in list_file:
+            writer.write_file(input_path)
+    except BaseException:
+        writer.abort()
+        raise
+
+    writer.close()
+
+    if log:
+        logging.info(f"Streamed {len(list_file)} files into '{file_path}'...")
+
+
+# Parquet output fed table by table: rows are buffered up to
+# `row_group_size`, conformed to one schema (taken from the first table
+# unless given) and written to `file_path`.tmp, which replaces `file_path`
+# on close(). Nothing is written if no table ever arrives. Every row group
+# written is also passed on to the `downstream` writers.
+class StreamWriter:
+    def __init__(
+        self,
+        file_path,
+        schema=None,
+        row_group_size=100_000,
+        target="merge",
+        downstream=None,
+    ):
+        self.file_path = file_path
+        self.schema = schema
+        self.row_group_size = row_group_size
+        self.target = target
+        self.downstream = downstream or []
+
+        self.writer = None
+        self.list_table = []
+        self.rows = 0
+        self.total = 0
+
+    def write(self, table):
+        if self.schema is None:
+            self.schema = dictionary_schema(table.schema)
+
+        if self.writer is None:
+            check_dir(os.path.dirname(self.file_path))
+            self.writer = pq.ParquetWriter(f"{self.file_path}.tmp", self.schema)
+
+        table = conform_table(table, self.schema)
+        self.list_table.append(table)
+        self.rows += table.num_rows
+        self.total += table.num_rows
+
+        if self.rows >= self.row_group_size:
+            self.flush()
+
+        return table
+
+    def write_file(self, input_path):
+        parquet_file = pq.ParquetFile(input_path)
+
+        for index in range(parquet_file.num_row_groups):
+            self.write(parquet_file.read_row_group(index))
+
+    def flush(self):
+        if self.list_table:
+            table = write_row_group(self.writer, self.list_table)
+            self.list_table = []
+            self.rows = 0
+
+            for writer in self.downstream:
+                writer.write(table)
+
+    def close(self):
+        if self.writer is None:
+            return 0
+
+        self.flush()
+        self.writer.close()
+        self.writer = None
+
+        os.replace(f"{self.file_path}.tmp", self.file_path)
+        record_write(self.file_path, self.total, target=self.target)
+
+        return self.total
+
+    def abort(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+            os.remove(f"{self.file_path}.tmp")
+
+
+def merge_schema(list_file):
+    # Union of every input's columns (only the Parquet footers are read), so
+    # conform_table never drops a column that only some inputs have.
+    schema = pq.read_schema(list_file[0])
+    names = set(schema.names)
+
+    for file in list_file[1:]:
+        for field in pq.read_schema(file):
+            if field.name not in names:
+                schema = schema.append(field)
+                names.add(field.name)
+
+    return dictionary_schema(schema)
+
+
+def dictionary_schema(schema):
+    # int32 dictionary indices, so categories from many inputs always fit.
+    return pa.schema(
+        [
+            (
+                pa.field(field.name, pa.dictionary(pa.int32(), field.type.value_type))
+                if pa.types.is_dictionary(field.type)
+                else field
+            )
+            for field in schema
+        ],
+        metadata=schema.metadata,
+    )
+
+
+def conform_table(table, schema):
+    if table.schema.equals(schema):
+        return table
+
+    # column_names builds a new list on every access, so it is read once.
+    column_names = set(table.column_names)
+    columns = []
+
+    for field in schema:
+        if field.name not in column_names:
+            columns.append(pa.nulls(table.num_rows, field.type))
+            continue
+
+        column = table[field.name]
+        columns.append(column if column.type == field.type else column.cast(field.type))
+
+    return pa.Table.from_arrays(columns, schema=schema)
+
+
+def write_row_group(writer, list_table):
+    table = pa.concat_tables(list_table).unify_dictionaries().combine_chunks()
+    writer.write_table(table, row_group_size=table.num_rows)
+
+    return table
+
+
 def merge_df(params, uf=False, country=False, log=False):
     df = params["ibge_data"].sort_values(by=["mesorregiao_uf", "municipio"])
 
@@ -259,4 +1030,4 @@ def merge_df(params, uf=False, country=False, log=False):
 
 
 def create_df(list_df):
-    return pd.concat(list_df, ignore_index=True)
+    return concat_frames(list_df)
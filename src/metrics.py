@@ -0,0 +1,301 @@
+import cProfile
+import functools
+import io
+import json
+import logging
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+# Process-wide counters, gauges, timers and histograms keyed by
+# (name, labels).
+# Worker processes drain() their share and the parent update()s it back.
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.timers = {}
+        self.histograms = {}
+
+    def _key(self, name, labels):
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        key = self._key(name, labels)
+
+        with self.lock:
+            self.gauges[key] = value
+
+    def record(self, name, seconds, **labels):
+        key = self._key(name, labels)
+
+        with self.lock:
+            count, total, longest = self.timers.get(key, (0, 0.0, 0.0))
+            self.timers[key] = (count + 1, total + seconds, max(longest, seconds))
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        key = self._key(name, labels)
+
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = {
+                    "buckets": list(buckets),
+                    "counts": [0] * len(buckets),
+                    "count": 0,
+                    "sum": 0.0,
+                }
+                self.histograms[key] = histogram
+
+            for index, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram["counts"][index] += 1
+                    break
+
+            histogram["count"] += 1
+            histogram["sum"] += value
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start, **labels)
+
+    def drain(self):
+        with self.lock:
+            snapshot = (self.counters, self.gauges, self.timers, self.histograms)
+            self.counters, self.gauges, self.timers, self.histograms = {}, {}, {}, {}
+
+        return snapshot
+
+    def update(self, snapshot):
+        counters, gauges, timers, histograms = snapshot
+
+        with self.lock:
+            for key, value in counters.items():
+                self.counters[key] = self.counters.get(key, 0) + value
+
+            self.gauges.update(gauges)
+
+            for key, (count, total, longest) in timers.items():
+                old = self.timers.get(key, (0, 0.0, 0.0))
+                self.timers[key] = (
+                    old[0] + count,
+                    old[1] + total,
+                    max(old[2], longest),
+                )
+
+            for key, histogram in histograms.items():
+                old = self.histograms.get(key)
+                if old is None:
+                    self.histograms[key] = histogram
+                    continue
+
+                old["counts"] = [
+                    a + b for a, b in zip(old["counts"], histogram["counts"])
+                ]
+                old["count"] += histogram["count"]
+                old["sum"] += histogram["sum"]
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                "counters": [
+                    {"name": name, "labels": dict(labels), "value": value}
+                    for (name, labels), value in sorted(self.counters.items())
+                ],
+                "gauges": [
+                    {"name": name, "labels": dict(labels), "value": value}
+                    for (name, labels), value in sorted(self.gauges.items())
+                ],
+                "timers": [
+                    {
+                        "name": name,
+                        "labels": dict(labels),
+                        "count": count,
+                        "seconds": round(total, 6),
+                        "max_seconds": round(longest, 6),
+                    }
+                    for (name, labels), (count, total, longest) in sorted(
+                        self.timers.items()
+                    )
+                ],
+                "histograms": [
+                    {"name": name, "labels": dict(labels), **histogram}
+                    for (name, labels), histogram in sorted(
+                        self.histograms.items(), key=lambda item: item[0]
+                    )
+                ],
+            }
+
+    def to_prometheus(self, prefix="aedes"):
+        def series(name, labels, value, extra=()):
+            text = ",".join(f'{k}="{v}"' for k, v in [*labels.items(), *extra])
+            if text:
+                return f"{prefix}_{name}{{{text}}} {value}"
+            return f"{prefix}_{name} {value}"
+
+        data = self.to_dict()
+        lines = []
+
+        for counter in data["counters"]:
+            name, labels = counter["name"], counter["labels"]
+            lines.append(series(f"{name}_total", labels, counter["value"]))
+
+        for gauge in data["gauges"]:
+            lines.append(series(gauge["name"], gauge["labels"], gauge["value"]))
+
+        for timer in data["timers"]:
+            name, labels = timer["name"], timer["labels"]
+            lines.append(series(f"{name}_seconds_count", labels, timer["count"]))
+            lines.append(series(f"{name}_seconds_sum", labels, timer["seconds"]))
+
+        for histogram in data["histograms"]:
+            name, labels = histogram["name"], histogram["labels"]
+            cumulative = 0
+
+            for bound, count in zip(histogram["buckets"], histogram["counts"]):
+                cumulative += count
+                lines.append(
+                    series(f"{name}_bucket", labels, cumulative, [("le", bound)])
+                )
+
+            lines.append(
+                series(f"{name}_bucket", labels, histogram["count"], [("le", "+Inf")])
+            )
+            lines.append(series(f"{name}_sum", labels, histogram["sum"]))
+            lines.append(series(f"{name}_count", labels, histogram["count"]))
+
+        return "\n".join(lines) + "\n"
+
+
+_metrics = Metrics()
+
+# Opt-in profiling, e.g. {"merge_city": ["cprofile", "tracemalloc"]}.
+_profile = {"stages": {}, "path": "data/_profile"}
+
+
+def get_metrics():
+    return _metrics
+
+
+def reset_metrics():
+    # Pool initializer: forked workers must not report the parent's counts.
+    _metrics.drain()
+
+
+def record_write(file_path, rows, target, size=None):
+    # `size` is what this write added, for appends; whole files by default.
+    if size is None:
+        size = os.path.getsize(file_path)
+
+    _metrics.inc("rows_written", rows, target=target)
+    _metrics.inc("bytes_written", size, target=target)
+
+
+def configure_metrics(params):
+    _profile["stages"] = dict(params.get("profile_stages") or {})
+    _profile["path"] = params.get("profile_path", _profile["path"])
+
+
+@contextmanager
+def profile_stage(stage, log=False):
+    tools = _profile["stages"].get(stage, [])
+
+    if not tools:
+        yield
+        return
+
+    os.makedirs(_profile["path"], exist_ok=True)
+
+    profiler = cProfile.Profile() if "cprofile" in tools else None
+    trace = "tracemalloc" in tools and not tracemalloc.is_tracing()
+
+    if trace:
+        tracemalloc.start()
+    if profiler is not None:
+        profiler.enable()
+
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            file_path = os.path.join(_profile["path"], f"{stage}.prof")
+            profiler.dump_stats(file_path)
+
+            if log:
+                stream = io.StringIO()
+                pstats.Stats(profiler, stream=stream).sort_stats(
+                    "cumulative"
+                ).print_stats(15)
+                logging.info(f"cProfile for stage '{stage}' in '{file_path}':")
+                logging.info(stream.getvalue())
+
+        if trace:
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            _metrics.set("tracemalloc_peak_bytes", peak, stage=stage)
+
+            file_path = os.path.join(_profile["path"], f"{stage}.tracemalloc.txt")
+            with open(file_path, "w") as f:
+                f.write(f"peak {peak} bytes, current {current} bytes\n")
+                for stat in snapshot.statistics("lineno")[:50]:
+                    f.write(f"{stat}\n")
+
+            if log:
+                logging.info(
+                    f"tracemalloc for stage '{stage}': peak {peak / 2**20:.1f} MiB, "
+                    f"top allocations in '{file_path}'..."
+                )
+
+
+def instrument(stage):
+    # Times every call of a pipeline stage and applies the opt-in profilers.
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with profile_stage(stage, log=kwargs.get("log", False)):
+                with _metrics.timer("stage", stage=stage):
+                    return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def write_metrics(params, log=False):
+    metrics_path = params.get("metrics_path")
+    if not metrics_path:
+        return
+
+    os.makedirs(metrics_path, exist_ok=True)
+
+    json_path = os.path.join(metrics_path, "metrics.json")
+    with open(json_path, "w") as f:
+        json.dump(_metrics.to_dict(), f, indent=2)
+
+    prometheus_path = os.path.join(metrics_path, "metrics.prom")
+    with open(prometheus_path, "w") as f:
+        f.write(_metrics.to_prometheus())
+
+    if log:
+        logging.info(f"Metrics written to '{json_path}' and '{prometheus_path}'...")
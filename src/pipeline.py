@@ -0,0 +1,308 @@
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from src.cube import merge_cubes
+from src.ibge import process_ibge_data
+from src.infodengue import plan_requests, request_geocode, run_geocode
+from src.merge import get_params_merge, merge_country, merge_one_city, merge_one_uf
+from src.metrics import get_metrics, instrument, reset_metrics
+from src.shard import write_shard_report
+from src.utils import set_csv_path
+
+
+# Stage-by-stage alternative to prepare_api_request followed by merge_*:
+#
+#   fetch (threads) -> [fetched] -> transform (processes) -> [merged] -> UF writer
+#
+# The year frames a city's fetch just saved travel with it through [fetched],
+# so the transform only reads its other years from disk. Queues are bounded,
+# so a slow stage blocks the one feeding it instead of letting work pile up
+# in memory. A UF file is written as soon as its last city is transformed;
+# the country file and cubes follow once all UFs are. A failing stage sets
+# `stop`, and every queue wait gives up once it is set.
+@instrument("pipeline")
+def run_pipeline(params, log=False):
+    fetch_workers = params.get("workers", 1)
+    transform_workers = params.get("merge_workers", 1)
+    queue_size = params.get("pipeline_queue_size", 64)
+
+    params_request, df_request = plan_requests(params, log=log)
+
+    params["ibge_data"] = (
+        process_ibge_data(params=params, log=log)
+        .sort_values(by=["mesorregiao_uf", "geocode"])
+        .reset_index(drop=True)
+    )
+
+    df_city = params["ibge_data"].copy()
+    df_city["csv_path"] = set_csv_path(params, log=log)
+    uf_path = set_csv_path(params, uf=True)
+
+    fetched = queue.Queue(maxsize=queue_size)
+    merged = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+
+    if log:
+        logging.info(
+            f"Pipeline: {len(df_city)} cities, {len(df_request)} pairs to fetch, "
+            f"{fetch_workers} fetch / {transform_workers} transform workers, "
+            f"queues of {queue_size}..."
+        )
+
+    start = time.perf_counter()
+
+    producer = threading.Thread(
+        target=fetch_stage,
+        args=(params_request, df_request, df_city, fetched, stop, fetch_workers, log),
+        daemon=True,
+    )
+    writer = threading.Thread(
+        target=write_stage,
+        args=(params, df_city.assign(uf_path=uf_path), merged, stop, log),
+        daemon=True,
+    )
+    producer.start()
+    writer.start()
+
+    try:
+        list_result = transform_stage(
+            params, fetched, merged, stop, transform_workers, log
+        )
+    except BaseException:
+        stop.set()
+        try:
+            merged.put_nowait(None)
+        except queue.Full:
+            pass
+        raise
+
+    producer.join()
+    writer.join()
+
+    if stop.is_set():
+        raise RuntimeError(
+            "Pipeline stopped by a failing stage, see the errors above"
+        )
+
+    params["dirty_uf"] = {uf for status, uf, _, _ in list_result if status == "merged"}
+    params["dirty_city"] = {
+        geocode for status, _, _, geocode in list_result if status == "merged"
+    }
+
+    for status, uf, message, geocode in list_result:
+        if status == "failed":
+            logging.error(message)
+
+    if log:
+        summary = {
+            status: sum(1 for result in list_result if result[0] == status)
+            for status in ["merged", "skipped", "empty", "failed"]
+        }
+        logging.info(
+            f"Pipeline cities done in {time.perf_counter() - start:.2f}s: {summary}"
+        )
+
+    # A shard only holds part of every UF; the coordinator writes the rest.
+    if params.get("shard"):
+        write_shard_report(params, log=log)
+        return
+
+    merge_country(params=params, log=log)
+    merge_cubes(params=params, log=log)
+
+
+def put_item(queue_stage, item, stop):
+    # Blocking put that gives up once the pipeline is stopped, so fetch
+    # workers never hang on a queue nobody reads any more.
+    while not stop.is_set():
+        try:
+            queue_stage.put(item, timeout=1)
+            return True
+        except queue.Full:
+            continue
+
+    return False
+
+
+def get_item(queue_stage, stop):
+    # Blocking get that returns None once the pipeline is stopped.
+    while not stop.is_set():
+        try:
+            return queue_stage.get(timeout=1)
+        except queue.Empty:
+            continue
+
+    return None
+
+
+def fetch_stage(
+    params_request, df_request, df_city, fetched, stop, workers, log=False
+):
+    # Cities with nothing stale go straight to the transform stage; the rest
+    # are handed on as soon as their last disease is saved. put() blocks
+    # while the queue is full, which throttles the fetch workers.
+    dict_rows = {
+        geocode: rows for geocode, rows in df_request.groupby("geocode", sort=False)
+    }
+    metrics = get_metrics()
+
+    def fetch(row):
+        if stop.is_set():
+            return
+
+        rows = dict_rows.get(row["geocode"])
+        frames = None
+
+        if rows is not None:
+            try:
+                frames = run_geocode(
+                    request_geocode, dict(params_request), rows, log=log
+                )
+            except Exception as e:
+                metrics.inc("geocodes_failed")
+                logging.error(f"Geocoding {row['geocode']} failed: {e}")
+
+        with metrics.timer("pipeline_wait", stage="fetch"):
+            put_item(fetched, (row, frames), stop)
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            list(executor.map(fetch, [row for _, row in df_city.iterrows()]))
+    finally:
+        put_item(fetched, None, stop)
+
+
+def transform_stage(params, fetched, merged, stop, workers, log=False):
+    params_merge = get_params_merge(params)
+    metrics = get_metrics()
+    list_result = []
+
+    def done(row, result):
+        *result, snapshot = result
+        metrics.update(snapshot)
+
+        result = (*result, row["geocode"])
+        list_result.append(result)
+
+        with metrics.timer("pipeline_wait", stage="transform"):
+            if not put_item(merged, (row, result), stop):
+                raise RuntimeError(
+                    "Pipeline stopped by a failing stage, see the errors above"
+                )
+
+    def next_item():
+        with metrics.timer("pipeline_wait", stage="transform_input"):
+            item = get_item(fetched, stop)
+
+        if item is None and stop.is_set():
+            raise RuntimeError(
+                "Pipeline stopped by a failing stage, see the errors above"
+            )
+
+        return item
+
+    if workers <= 1:
+        while (item := next_item()) is not None:
+            row, frames = item
+            done(row, merge_one_city(params_merge, row, log=log, frames=frames))
+
+        put_item(merged, None, stop)
+        return list_result
+
+    # Pool callbacks run on the executor's management thread, so they only
+    # hand results to `finished`; this thread passes them on to the writer.
+    # At most 2 x workers cities are in flight (or finished but not passed
+    # on), so the bounded input queue still pushes back on the fetch stage.
+    finished = queue.Queue()
+    inflight = 0
+
+    def callback(future, row):
+        try:
+            result = future.result()
+        except Exception as e:
+            result = (
+                "failed",
+                row["mesorregiao_uf"],
+                f"{row['municipio']} - Merge failed: {e!r}",
+                ({}, {}, {}, {}),
+            )
+        finished.put((row, result))
+
+    def collect(block):
+        nonlocal inflight
+        while inflight:
+            try:
+                row, result = finished.get(block=block)
+            except queue.Empty:
+                return
+            inflight -= 1
+            done(row, result)
+            block = False
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=reset_metrics) as executor:
+        try:
+            while (item := next_item()) is not None:
+                row, frames = item
+
+                if inflight >= workers * 2:
+                    collect(block=True)
+
+                future = executor.submit(
+                    merge_one_city, params_merge, row, log, False, frames
+                )
+                future.add_done_callback(lambda future, row=row: callback(future, row))
+                inflight += 1
+
+                collect(block=False)
+
+            while inflight:
+                collect(block=True)
+        except BaseException:
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+
+    put_item(merged, None, stop)
+    return list_result
+
+
+def write_stage(params, df_city, merged, stop, log=False):
+    # Counts down the cities of every UF and streams the UF file once the
+    # last one arrives; merge_one_uf skips it if its city files are unchanged.
+    # If this stage fails it stops the pipeline, so nothing waits on it.
+    try:
+        run_write_stage(params, df_city, merged, stop, log=log)
+    except BaseException as e:
+        logging.error(f"Pipeline write stage failed: {e!r}")
+        stop.set()
+        raise
+
+
+def run_write_stage(params, df_city, merged, stop, log=False):
+    if params.get("output_layout", "wide") == "star" or params.get("shard"):
+        while get_item(merged, stop) is not None:
+            pass
+        return
+
+    infodengue_file_name = params["infodengue_file_name"]
+    remaining = df_city["mesorregiao_uf"].value_counts().to_dict()
+
+    while True:
+        item = get_item(merged, stop)
+        if item is None:
+            break
+
+        row, (status, uf, _, _) = item
+        remaining[uf] -= 1
+
+        if remaining[uf]:
+            continue
+
+        df_uf = df_city[df_city["mesorregiao_uf"] == uf]
+
+        try:
+            with get_metrics().timer("pipeline_uf", uf=uf):
+                merge_one_uf(infodengue_file_name, uf, df_uf, log=log)
+        except Exception as e:
+            logging.error(f"UF [{uf}] merge failed: {e!r}")
@@ -0,0 +1,223 @@
+import logging
+import os
+import pandas as pd
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+from src.schema import GEOGRAPHY_COLUMNS, concat_frames
+from src.star import get_country_path, get_fact_path, join_ibge, read_dimension
+from src.utils import check_file
+
+
+# Partial aggregates computed per record batch, and how partials combine.
+# "mean" is carried as a sum and a count and divided at the end.
+PARTIAL_AGG = {"sum": "sum", "count": "sum", "min": "min", "max": "max"}
+
+
+def get_query_files(params, list_uf=None):
+    # Wide layout: a UF selection reads only those UF files (file-level
+    # partition pruning); anything else scans the national file.
+    infodengue_file_name = params["infodengue_file_name"]
+    country_path = get_country_path(params)
+
+    if list_uf:
+        list_file = [
+            os.path.join(
+                country_path, uf.lower(), f"{infodengue_file_name}_{uf.lower()}.parquet"
+            )
+            for uf in list_uf
+        ]
+
+        if all(check_file(file, type="parquet") for file in list_file):
+            return list_file
+
+    country = params["country"].lower()
+
+    return [os.path.join(country_path, f"{infodengue_file_name}_{country}.parquet")]
+
+
+def build_expression(
+    list_uf=None, list_city=None, list_disease=None, years=None, filters=None
+):
+    list_expression = []
+
+    if list_uf:
+        list_expression.append(pc.field("mesorregiao_uf").isin(list(list_uf)))
+    if list_city:
+        list_expression.append(pc.field("municipio").isin(list(list_city)))
+    if list_disease:
+        list_expression.append(pc.field("disease").isin(list(list_disease)))
+    if years is not None:
+        list_expression.append(pc.field("year").isin(list(years)))
+
+    for column, op, value in filters or []:
+        field = pc.field(column)
+
+        if op == "in":
+            list_expression.append(field.isin(list(value)))
+        elif op == "not in":
+            list_expression.append(~field.isin(list(value)))
+        else:
+            list_expression.append(
+                {
+                    "==": field == value,
+                    "!=": field != value,
+                    "<": field < value,
+                    "<=": field <= value,
+                    ">": field > value,
+                    ">=": field >= value,
+                }[op]
+            )
+
+    if not list_expression:
+        return None
+
+    expression = list_expression[0]
+    for item in list_expression[1:]:
+        expression &= item
+
+    return expression
+
+
+def query(
+    params,
+    list_uf=None,
+    list_city=None,
+    list_disease=None,
+    years=None,
+    columns=None,
+    filters=None,
+    group_by=None,
+    agg=None,
+    log=False,
+):
+    # `agg` follows pandas named aggregation: {"sum": ("casos", "sum")}.
+    # Filters and columns are pushed down to the Parquet scan, so only the
+    # matching row groups and columns are read; aggregations are reduced one
+    # record batch at a time. An empty group_by reduces to a single row.
+    group_by = list(group_by or [])
+    star = params.get("output_layout", "wide") == "star"
+
+    if agg is not None:
+        columns = list(
+            dict.fromkeys([*group_by, *[column for column, _ in agg.values()]])
+        )
+    elif columns is not None:
+        columns = list(columns)
+
+    if star:
+        list_file = [get_fact_path(params)]
+        expression = build_expression(
+            list_disease=list_disease, years=years, filters=filters
+        )
+
+        ibge_columns = [
+            column
+            for column in columns or GEOGRAPHY_COLUMNS
+            if column in GEOGRAPHY_COLUMNS
+        ]
+        df_dim = read_dimension(
+            params, columns=sorted({*ibge_columns, "mesorregiao_uf", "municipio"})
+        )
+
+        if list_uf or list_city:
+            mask = pd.Series(True, index=df_dim.index)
+            if list_uf:
+                mask &= df_dim["mesorregiao_uf"].isin(list_uf)
+            if list_city:
+                mask &= df_dim["municipio"].isin(list_city)
+
+            geocode = pc.field("geocode").isin(df_dim.loc[mask, "geocode"].tolist())
+            expression = geocode if expression is None else expression & geocode
+
+        df_dim = df_dim[["geocode", *ibge_columns]]
+
+        if columns is not None:
+            columns = [
+                "geocode",
+                *[
+                    column
+                    for column in columns
+                    if column not in GEOGRAPHY_COLUMNS and column != "geocode"
+                ],
+            ]
+    else:
+        list_file = get_query_files(params, list_uf=list_uf)
+        expression = build_expression(
+            list_uf=list_uf,
+            list_city=list_city,
+            list_disease=list_disease,
+            years=years,
+            filters=filters,
+        )
+        df_dim = None
+
+    if log:
+        logging.info(f"Querying {list_file} with filter {expression}...")
+
+    scanner = ds.dataset(list_file, format="parquet").scanner(
+        columns=columns, filter=expression
+    )
+
+    if agg is None:
+        df = scanner.to_table().to_pandas()
+        if df_dim is not None:
+            df = join_ibge(df, df_dim)
+
+        return df
+
+    dict_partial = partial_agg(agg)
+    list_partial = []
+
+    for batch in scanner.to_batches():
+        if not batch.num_rows:
+            continue
+
+        df = batch.to_pandas()
+        if df_dim is not None:
+            df = join_ibge(df, df_dim)
+
+        df = aggregate(df, group_by, dict_partial)
+        list_partial.append(df.reset_index() if group_by else df)
+
+    if not list_partial:
+        df = pd.DataFrame(columns=[*group_by, *agg])
+        return df.set_index(group_by) if group_by else df
+
+    df = aggregate(
+        concat_frames(list_partial),
+        group_by,
+        {
+            name: (name, PARTIAL_AGG[func])
+            for name, (column, func) in dict_partial.items()
+        },
+    )
+
+    for name, (column, func) in agg.items():
+        if func == "mean":
+            df[name] = df[f"{name}__sum"] / df[f"{name}__count"]
+
+    return df[list(agg)]
+
+
+def aggregate(df, group_by, named_agg):
+    if group_by:
+        return df.groupby(group_by, observed=True).agg(**named_agg)
+
+    return pd.DataFrame(
+        {name: [df[column].agg(func)] for name, (column, func) in named_agg.items()}
+    )
+
+
+def partial_agg(agg):
+    dict_partial = {}
+
+    for name, (column, func) in agg.items():
+        if func == "mean":
+            dict_partial[f"{name}__sum"] = (column, "sum")
+            dict_partial[f"{name}__count"] = (column, "count")
+        elif func in PARTIAL_AGG:
+            dict_partial[name] = (column, func)
+        else:
+            raise ValueError(f"Unsupported aggregation '{func}' for '{name}'")
+
+    return dict_partial
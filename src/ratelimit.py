@@ -0,0 +1,106 @@
+import logging
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+
+
+# Token bucket shared by every request sent to one host. The refill rate is
+# AIMD: each success adds `increase` req/s, a throttle event multiplies it by
+# `decrease` and blocks the bucket until the server's Retry-After expires.
+class RateLimiter:
+    def __init__(
+        self, rate=10, burst=None, min_rate=0.5, max_rate=50, increase=0.1, decrease=0.5
+    ):
+        self.rate = rate
+        self.burst = burst or max(1, rate)
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+        self.decreased = 0
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+
+                if now < self.blocked_until:
+                    wait = self.blocked_until - now
+                else:
+                    self._refill(now)
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return now
+                    wait = (1 - self.tokens) / self.rate
+
+            time.sleep(wait)
+
+    def success(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def throttled(self, retry_after=None, sent=None):
+        # `sent` is what acquire() returned for the throttled request. 429s of
+        # requests sent before the last cut, or arriving while the bucket is
+        # blocked, belong to the same event: the rate is only cut once for it.
+        with self.lock:
+            now = time.monotonic()
+
+            if now >= self.blocked_until and (sent is None or sent >= self.decreased):
+                self.rate = max(self.min_rate, self.rate * self.decrease)
+                self.decreased = now
+
+            self.tokens = 0
+            self.updated = now
+
+            wait = retry_after if retry_after is not None else 1 / self.rate
+            self.blocked_until = max(self.blocked_until, now + wait)
+
+            return wait
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(url, rate=10, log=False):
+    host = urlparse(url).netloc
+
+    with _limiters_lock:
+        limiter = _limiters.get(host)
+
+        if limiter is None:
+            if log:
+                logging.info(f"Rate limiting '{host}' to {rate} requests/s...")
+
+            limiter = RateLimiter(rate=rate)
+            _limiters[host] = limiter
+
+    return limiter
+
+
+def parse_retry_after(value):
+    if not value:
+        return None
+
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        date = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+
+    return max(0, date.timestamp() - time.time())
@@ -0,0 +1,181 @@
+import logging
+import pandas as pd
+import pyarrow as pa
+
+
+# Raw InfoDengue rows as stored by the fetch stage. Measures are float64 so
+# that missing values survive every storage backend unchanged.
+RAW_SCHEMA = pa.schema(
+    [
+        ("disease", pa.string()),
+        ("geocode", pa.int64()),
+        ("data_iniSE", pa.int64()),
+        ("SE", pa.int32()),
+        ("casos_est", pa.float64()),
+        ("casos_est_min", pa.float64()),
+        ("casos_est_max", pa.float64()),
+        ("casos", pa.float64()),
+        ("p_rt1", pa.float64()),
+        ("p_inc100k", pa.float64()),
+        ("Localidade_id", pa.float64()),
+        ("nivel", pa.float64()),
+        ("id", pa.float64()),
+        ("versao_modelo", pa.string()),
+        ("tweet", pa.float64()),
+        ("Rt", pa.float64()),
+        ("pop", pa.float64()),
+        ("tempmin", pa.float64()),
+        ("umidmax", pa.float64()),
+        ("receptivo", pa.float64()),
+        ("transmissao", pa.float64()),
+        ("nivel_inc", pa.float64()),
+        ("umidmed", pa.float64()),
+        ("umidmin", pa.float64()),
+        ("tempmed", pa.float64()),
+        ("tempmax", pa.float64()),
+        ("casprov", pa.float64()),
+        ("casprov_est", pa.float64()),
+        ("casprov_est_min", pa.float64()),
+        ("casprov_est_max", pa.float64()),
+        ("casconf", pa.float64()),
+        ("notif_accum_year", pa.float64()),
+    ]
+)
+
+RAW_COLUMNS = RAW_SCHEMA.names
+
+
+def raw_table(df):
+    df = df.reindex(columns=RAW_COLUMNS)
+
+    # The integer columns are the row keys; a row missing one cannot be
+    # placed, so it is dropped instead of failing the whole table's cast.
+    keys = [field.name for field in RAW_SCHEMA if pa.types.is_integer(field.type)]
+    df[keys] = df[keys].apply(pd.to_numeric, errors="coerce")
+    mask_null = df[keys].isna().any(axis=1)
+
+    if mask_null.any():
+        logging.warning(f"Dropping {mask_null.sum()} raw rows with null {keys}...")
+        df = df[~mask_null]
+
+    for field in RAW_SCHEMA:
+        if pa.types.is_string(field.type):
+            df[field.name] = df[field.name].astype("string")
+        elif pa.types.is_integer(field.type):
+            df[field.name] = df[field.name].astype(field.type.to_pandas_dtype())
+        else:
+            df[field.name] = df[field.name].astype("float64")
+
+    return pa.Table.from_pandas(df, schema=RAW_SCHEMA, preserve_index=False)
+
+
+GEOGRAPHY_COLUMNS = [
+    "country",
+    "municipio",
+    "microrregiao",
+    "mesorregiao",
+    "mesorregiao_uf",
+    "mesorregiao_uf_nome",
+    "mesorregiao_uf_regiao_nome",
+    "regiao_imediata",
+    "regiao_intermediaria",
+    "regiao_intermediaria_uf",
+    "regiao_intermediaria_uf_nome",
+    "regiao_intermediaria_uf_regiao_nome",
+]
+
+# Bumped whenever OUTPUT_DTYPES change; it is part of every city's merge
+# fingerprint, so existing city files are rebuilt with the new dtypes.
+OUTPUT_VERSION = 2
+
+# Merged (city/UF/country) output columns in file order. Strings that repeat
+# on every weekly row are categoricals, written as Parquet dictionaries.
+# p_inc100k stays float64: rounded to 4 decimals, epidemic-year incidences
+# in the thousands need more digits than float32 holds.
+OUTPUT_DTYPES = {
+    "disease": "category",
+    "geocode": "int32",
+    "SE": "int8",
+    "casos_est": "int32",
+    "casos_est_min": "int32",
+    "casos_est_max": "int32",
+    "casos": "int32",
+    "p_rt1": "float32",
+    "p_inc100k": "float64",
+    "nivel": "Int8",
+    "Rt": "float32",
+    "pop": "int32",
+    "tempmin": "float32",
+    "umidmax": "float32",
+    "receptivo": "category",
+    "transmissao": "category",
+    "nivel_inc": "category",
+    "umidmed": "float32",
+    "umidmin": "float32",
+    "tempmed": "float32",
+    "tempmax": "float32",
+    "casprov": "float32",
+    "casprov_est": "float32",
+    "casprov_est_min": "float32",
+    "casprov_est_max": "float32",
+    "casconf": "float32",
+    "notif_accum_year": "int32",
+    "year": "int16",
+    **{column: "category" for column in GEOGRAPHY_COLUMNS},
+}
+
+
+# Star layout: weekly facts keyed by geocode, geography kept in one dimension.
+FACT_COLUMNS = [
+    column for column in OUTPUT_DTYPES if column not in GEOGRAPHY_COLUMNS
+]
+
+DIMENSION_COLUMNS = ["geocode", *GEOGRAPHY_COLUMNS]
+
+
+def apply_output_schema(df, columns=None):
+    if columns is None:
+        columns = list(OUTPUT_DTYPES)
+
+    return df.reindex(columns=columns).astype(
+        {column: OUTPUT_DTYPES[column] for column in columns}
+    )
+
+
+def concat_frames(list_df):
+    # pd.concat falls back to object dtype when categoricals disagree on their
+    # categories, so every frame is first recoded onto the sorted union.
+    list_df = [df for df in list_df if not df.empty] or list_df
+
+    dict_categories = {}
+
+    for column, dtype in list_df[0].dtypes.items():
+        if not all(
+            column in df.columns and isinstance(df[column].dtype, pd.CategoricalDtype)
+            for df in list_df
+        ):
+            continue
+
+        if all(
+            df[column].cat.categories.equals(dtype.categories) for df in list_df
+        ):
+            continue
+
+        categories = set()
+        for df in list_df:
+            categories.update(df[column].cat.categories)
+
+        dict_categories[column] = sorted(categories)
+
+    if dict_categories:
+        list_df = [
+            df.assign(
+                **{
+                    column: df[column].cat.set_categories(categories)
+                    for column, categories in dict_categories.items()
+                }
+            )
+            for df in list_df
+        ]
+
+    return pd.concat(list_df, ignore_index=True)
@@ -0,0 +1,277 @@
+import glob
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import time
+import zlib
+from src.cube import merge_cubes
+from src.geography import get_geography
+from src.merge import merge_country, merge_uf, read_fingerprint
+from src.metrics import instrument
+from src.star import get_country_path
+from src.utils import check_dir, set_csv_path
+
+
+# A national run split into N independent workers (`shard`: "i/N"). Each
+# worker fetches and merges the cities of its slice, then leaves a report
+# under data/{country}/_shards; coordinate_shards() checks that all N have
+# reported and builds the UF/country files and cubes from their outputs.
+def parse_shard(shard):
+    try:
+        index, count = (int(value) for value in str(shard).split("/"))
+    except ValueError:
+        raise ValueError(f"Invalid shard '{shard}', expected 'i/N' such as '0/4'")
+
+    if count < 1 or not 0 <= index < count:
+        raise ValueError(f"Invalid shard '{shard}', expected 0 <= i < N")
+
+    return index, count
+
+
+def get_shard_name(index, count):
+    return f"shard-{index}-of-{count}"
+
+
+def configure_shard(params, log=False):
+    # Per-shard fetch manifest and metrics, so workers sharing a tree (or a
+    # network mount) never write the same SQLite or JSON file. A new shard
+    # manifest starts as a copy of the unsharded one, if any.
+    if not params.get("shard"):
+        return
+
+    index, count = parse_shard(params["shard"])
+    name = get_shard_name(index, count)
+    params["shard"] = f"{index}/{count}"
+
+    manifest_path = params.get("manifest_path")
+    if manifest_path:
+        root, ext = os.path.splitext(manifest_path)
+        shard_manifest_path = f"{root}.{name}{ext}"
+
+        if os.path.exists(manifest_path) and not os.path.exists(shard_manifest_path):
+            with sqlite3.connect(manifest_path) as source, sqlite3.connect(
+                shard_manifest_path
+            ) as target:
+                source.backup(target)
+
+        params["manifest_path"] = shard_manifest_path
+
+    for key in ["metrics_path", "profile_path"]:
+        if params.get(key):
+            params[key] = os.path.join(params[key], name)
+
+    if log:
+        logging.info(
+            f"Shard {index} of {count} by {params.get('shard_by', 'geocode')}..."
+        )
+
+
+def assign_shards(df, count, by="geocode", df_all=None):
+    # Stable across processes, machines and Python versions: CRC32 of the
+    # geocode, or whole UFs packed onto shards by city count (largest first,
+    # ties by name) over the full IBGE table in `df_all`.
+    if by == "geocode":
+        return df["geocode"].map(
+            lambda geocode: zlib.crc32(str(geocode).encode()) % count
+        )
+
+    if by == "uf":
+        if df_all is None:
+            df_all = df
+
+        sizes = df_all["mesorregiao_uf"].astype(str).value_counts()
+        load = [0] * count
+        dict_uf = {}
+
+        for uf, size in sorted(sizes.items(), key=lambda item: (-item[1], item[0])):
+            index = min(range(count), key=lambda i: (load[i], i))
+            dict_uf[uf] = index
+            load[index] += size
+
+        return df["mesorregiao_uf"].astype(str).map(dict_uf)
+
+    raise ValueError(f"Unsupported shard_by '{by}', expected 'geocode' or 'uf'")
+
+
+def select_shard(df, params, df_all=None, log=False):
+    index, count = parse_shard(params["shard"])
+    by = params.get("shard_by", "geocode")
+
+    mask = assign_shards(df, count, by=by, df_all=df_all) == index
+
+    if log:
+        logging.info(
+            f"Shard {index} of {count}: {int(mask.sum())} of {len(df)} cities..."
+        )
+
+    return df[mask.to_numpy()]
+
+
+def get_shard_path(params):
+    return os.path.join(get_country_path(params), "_shards")
+
+
+def write_shard_report(params, log=False):
+    # Dirty sets accumulate until a coordinator consumes the report, so a
+    # shard that runs twice in between does not hide its first changes.
+    index, count = parse_shard(params["shard"])
+    shard_path = get_shard_path(params)
+    check_dir(shard_path)
+
+    report_path = os.path.join(shard_path, f"{get_shard_name(index, count)}.json")
+    report = read_shard_report(report_path) or {"dirty_uf": [], "dirty_city": []}
+
+    report.update(
+        {
+            "shard": index,
+            "count": count,
+            "shard_by": params.get("shard_by", "geocode"),
+            "ibge_sha256": get_geography(params).content_hash,
+            "cities": len(params["ibge_data"]),
+            "dirty_uf": sorted(
+                set(report["dirty_uf"]) | set(params.get("dirty_uf") or [])
+            ),
+            "dirty_city": sorted(
+                set(report["dirty_city"])
+                | {int(geocode) for geocode in params.get("dirty_city") or []}
+            ),
+            "finished": time.time(),
+        }
+    )
+
+    tmp_path = f"{report_path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(report, f, indent=2)
+    os.replace(tmp_path, report_path)
+
+    if log:
+        logging.info(
+            f"Shard {index} of {count} done: {len(report['dirty_city'])} changed "
+            f"cities in {len(report['dirty_uf'])} UFs, report at '{report_path}'..."
+        )
+
+
+def read_shard_report(report_path):
+    if not os.path.exists(report_path):
+        return None
+
+    with open(report_path, "r") as f:
+        return json.load(f)
+
+
+def gather_shard(params, root, index, count, log=False):
+    # Copies the merged city files of one shard's tree into the local one,
+    # wherever its merge state differs. Returns the geocodes copied.
+    df = params["ibge_data"]
+    df = select_shard(
+        df.assign(csv_path=set_csv_path(params)),
+        {**params, "shard": f"{index}/{count}"},
+        df_all=df,
+    )
+
+    file_name = f"{params['infodengue_file_name']}.parquet"
+    list_gathered = []
+
+    for geocode, csv_path in zip(df["geocode"], df["csv_path"]):
+        source_path = os.path.join(root, csv_path)
+        source_state = os.path.join(source_path, "_merge_state.json")
+
+        if not os.path.exists(os.path.join(source_path, file_name)):
+            continue
+
+        state_path = os.path.join(csv_path, "_merge_state.json")
+        if read_fingerprint(state_path) == read_fingerprint(source_state):
+            continue
+
+        check_dir(csv_path)
+        for name in [file_name, "_merge_state.json"]:
+            tmp_path = os.path.join(csv_path, f"{name}.tmp")
+            shutil.copy2(os.path.join(source_path, name), tmp_path)
+            os.replace(tmp_path, os.path.join(csv_path, name))
+
+        list_gathered.append(int(geocode))
+
+    if log:
+        logging.info(
+            f"Gathered {len(list_gathered)} changed cities from shard {index} "
+            f"at '{root}'..."
+        )
+
+    return list_gathered
+
+
+@instrument("coordinate")
+def coordinate_shards(params, log=False):
+    # `shard_paths` lists the roots of per-shard trees (one working directory
+    # per worker or node); left empty, all shards wrote to this tree.
+    count = params["shard_count"]
+    list_root = params.get("shard_paths") or ["."]
+    content_hash = get_geography(params).content_hash
+
+    dict_report = {}
+    for root in list_root:
+        pattern = os.path.join(
+            root, get_shard_path(params), f"shard-*-of-{count}.json"
+        )
+
+        for report_path in glob.glob(pattern):
+            report = read_shard_report(report_path)
+            dict_report[report["shard"]] = (root, report_path, report)
+
+    missing = sorted(set(range(count)) - set(dict_report))
+    if missing:
+        raise RuntimeError(
+            f"Shards {missing} of {count} have not reported; run them before "
+            f"coordinating."
+        )
+
+    for index, (root, report_path, report) in sorted(dict_report.items()):
+        if report["ibge_sha256"] != content_hash:
+            raise RuntimeError(
+                f"Shard {index} of {count} used a different IBGE table "
+                f"('{report_path}'); refresh it and rerun the shard."
+            )
+
+    shard_by = {report["shard_by"] for _, _, report in dict_report.values()}
+    if len(shard_by) > 1:
+        raise RuntimeError(f"Shards were split by different keys: {sorted(shard_by)}")
+
+    dirty_uf = set()
+    dirty_city = set()
+
+    for index, (root, report_path, report) in sorted(dict_report.items()):
+        dirty_uf |= set(report["dirty_uf"])
+        dirty_city |= set(report["dirty_city"])
+
+        if os.path.abspath(root) != os.path.abspath("."):
+            list_gathered = gather_shard(
+                {**params, "shard_by": report["shard_by"]}, root, index, count, log=log
+            )
+            dirty_city |= set(list_gathered)
+
+    df = params["ibge_data"]
+    dirty_uf |= set(
+        df.loc[df["geocode"].isin(dirty_city), "mesorregiao_uf"].astype(str)
+    )
+
+    params["dirty_uf"] = dirty_uf
+    params["dirty_city"] = dirty_city
+
+    if log:
+        logging.info(
+            f"All {count} shards reported: {len(dirty_city)} changed cities in "
+            f"{sorted(dirty_uf)}..."
+        )
+
+    merge_uf(params=params, log=log)
+    merge_country(params=params, log=log)
+    merge_cubes(params=params, log=log)
+
+    # Consumed: the next coordination only sees shards that ran again.
+    for root, report_path, report in dict_report.values():
+        try:
+            os.replace(report_path, f"{report_path}.done")
+        except OSError as e:
+            logging.warning(f"Could not mark '{report_path}' as consumed: {e!r}")
@@ -0,0 +1,87 @@
+import logging
+import os
+from src.cube import CUBES, get_cube_path
+from src.star import get_country_path, get_dimension_path, get_fact_path
+from src.utils import check_dir, check_file
+
+
+def get_sql_connection(params, log=False):
+    # Registers the merged Parquet outputs as views of an in-memory DuckDB
+    # database. Queries scan the files directly with several threads and
+    # spill to `sql_temp_path` instead of loading them into pandas.
+    try:
+        import duckdb
+    except ImportError as e:
+        raise ImportError(
+            "The SQL backend needs the optional 'duckdb' package: pip install duckdb"
+        ) from e
+
+    conn = duckdb.connect()
+
+    threads = params.get("sql_threads")
+    if threads:
+        conn.execute(f"SET threads = {int(threads)}")
+
+    memory_limit = params.get("sql_memory_limit")
+    if memory_limit:
+        conn.execute(f"SET memory_limit = '{memory_limit}'")
+
+    temp_path = params.get(
+        "sql_temp_path", os.path.join(get_country_path(params), "_sql")
+    )
+    check_dir(temp_path, log=log)
+    conn.execute(f"SET temp_directory = '{temp_path}'")
+
+    for name, file_path in get_sql_views(params).items():
+        conn.execute(
+            f"CREATE VIEW {name} AS SELECT * FROM read_parquet('{file_path}')"
+        )
+
+        if log:
+            logging.info(f"SQL view '{name}' over '{file_path}'...")
+
+    if params.get("output_layout", "wide") == "star" and check_file(
+        get_fact_path(params), type="parquet"
+    ):
+        conn.execute(
+            "CREATE VIEW infodengue AS SELECT * FROM facts JOIN ibge USING (geocode)"
+        )
+
+    return conn
+
+
+def get_sql_views(params):
+    infodengue_file_name = params["infodengue_file_name"]
+    country = params["country"].lower()
+    country_path = get_country_path(params)
+
+    dict_view = {}
+
+    if params.get("output_layout", "wide") == "star":
+        dict_view["facts"] = get_fact_path(params)
+        dict_view["ibge"] = get_dimension_path(params)
+    else:
+        dict_view["infodengue"] = os.path.join(
+            country_path, f"{infodengue_file_name}_{country}.parquet"
+        )
+
+    for name in CUBES:
+        dict_view[name] = get_cube_path(params, name)
+
+    return {
+        name: file_path
+        for name, file_path in dict_view.items()
+        if check_file(file_path, type="parquet")
+    }
+
+
+def run_sql(params, statement, parameters=None, log=False):
+    conn = get_sql_connection(params, log=log)
+
+    try:
+        if log:
+            logging.info(f"Running SQL: {statement}")
+
+        return conn.execute(statement, parameters).df()
+    finally:
+        conn.close()
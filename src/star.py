@@ -0,0 +1,90 @@
+import logging
+import os
+import pandas as pd
+from src.schema import DIMENSION_COLUMNS, apply_output_schema
+
+
+def get_country_path(params):
+    return os.path.join("data", params["country"])
+
+
+def get_fact_path(params):
+    country = params["country"].lower()
+    file_name = f"{params['infodengue_file_name']}_{country}_facts.parquet"
+
+    return os.path.join(get_country_path(params), file_name)
+
+
+def get_dimension_path(params):
+    country = params["country"].lower()
+    file_name = f"{params['infodengue_file_name']}_{country}_ibge.parquet"
+
+    return os.path.join(get_country_path(params), file_name)
+
+
+def write_dimension(params, log=False):
+    dimension_path = get_dimension_path(params)
+
+    df = (
+        params["ibge_data"]
+        .drop_duplicates(subset=["geocode"])
+        .sort_values(by=["geocode"])
+    )
+    apply_output_schema(df, columns=DIMENSION_COLUMNS).to_parquet(
+        dimension_path, index=False
+    )
+
+    if log:
+        logging.info(f"IBGE dimension written to '{dimension_path}'...")
+
+
+def read_dimension(params, columns=None):
+    if columns is not None and "geocode" not in columns:
+        columns = ["geocode", *columns]
+
+    return pd.read_parquet(get_dimension_path(params), columns=columns)
+
+
+def read_facts(params, list_uf=None, list_city=None, columns=None, filters=None):
+    # UF/city selections become a geocode filter pushed down to the fact
+    # file, which is sorted by geocode so whole row groups are skipped.
+    filters = list(filters or [])
+
+    if list_uf or list_city:
+        df_dim = read_dimension(params, columns=["mesorregiao_uf", "municipio"])
+
+        mask = pd.Series(True, index=df_dim.index)
+        if list_uf:
+            mask &= df_dim["mesorregiao_uf"].isin(list_uf)
+        if list_city:
+            mask &= df_dim["municipio"].isin(list_city)
+
+        filters.append(("geocode", "in", df_dim.loc[mask, "geocode"].tolist()))
+
+    return pd.read_parquet(
+        get_fact_path(params), columns=columns, filters=filters or None
+    )
+
+
+def join_ibge(df, df_dim, columns=None):
+    if columns is not None:
+        df_dim = df_dim[["geocode", *[c for c in columns if c != "geocode"]]]
+
+    return df.merge(df_dim, on="geocode", how="left", validate="many_to_one")
+
+
+def read_view(
+    params, list_uf=None, list_city=None, columns=None, ibge_columns=None, filters=None
+):
+    if columns is not None and "geocode" not in columns:
+        columns = ["geocode", *columns]
+
+    df = read_facts(
+        params,
+        list_uf=list_uf,
+        list_city=list_city,
+        columns=columns,
+        filters=filters,
+    )
+
+    return join_ibge(df, read_dimension(params, columns=ibge_columns))
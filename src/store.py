@@ -0,0 +1,260 @@
+import glob
+import logging
+import os
+import uuid
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from src.metrics import record_write
+from src.schema import RAW_COLUMNS, RAW_SCHEMA, raw_table
+
+
+PARTITION_SCHEMA = pa.schema(
+    [
+        ("country", pa.string()),
+        ("uf", pa.string()),
+        ("year", pa.int32()),
+        ("disease", pa.string()),
+    ]
+)
+
+
+def get_store_path(params):
+    return params.get("store_path", "data/_store")
+
+
+def add_fetched_at(table):
+    now = pd.Timestamp.now().to_datetime64().astype("datetime64[ms]")
+    return table.append_column("fetched_at", pa.array(np.full(len(table), now)))
+
+
+def write_store(store_path, df, country, uf, max_fragments=None, log=False):
+    # Appends one fragment per (year, disease) instead of rewriting existing
+    # files; the newest fetched_at wins when the same week is read back. Once
+    # a geocode has more than `max_fragments` in a partition they are folded
+    # back into one, so weekly runs do not grow the store without bound.
+    if df.empty:
+        return
+
+    table = add_fetched_at(raw_table(df))
+
+    geocode = int(df["geocode"].iloc[0])
+    year = (df["SE"] // 100).to_numpy()
+    disease = df["disease"].to_numpy()
+
+    for key in sorted(set(zip(year.tolist(), disease.tolist()))):
+        mask = pa.array((year == key[0]) & (disease == key[1]))
+        partition_path = os.path.join(
+            store_path,
+            f"country={country}",
+            f"uf={uf.lower()}",
+            f"year={key[0]}",
+            f"disease={key[1]}",
+        )
+        os.makedirs(partition_path, exist_ok=True)
+
+        file_path = os.path.join(partition_path, f"{geocode}-{uuid.uuid4().hex}.parquet")
+        fragment = table.filter(mask).drop(["disease"])
+        pq.write_table(fragment, file_path)
+
+        record_write(file_path, len(fragment), target="store")
+
+        if log:
+            logging.info(f"Fragment '{file_path}' written...")
+
+        if max_fragments:
+            list_file = glob.glob(os.path.join(partition_path, f"{geocode}-*.parquet"))
+            if len(list_file) > max_fragments:
+                compact_fragments(store_path, partition_path, geocode, list_file, log=log)
+
+
+def store_files(store_path, country, uf, geocode, year=None):
+    return sorted(
+        glob.glob(
+            os.path.join(
+                store_path,
+                f"country={country}",
+                f"uf={uf.lower()}",
+                f"year={year if year is not None else '*'}",
+                "disease=*",
+                f"{geocode}-*.parquet",
+            )
+        )
+    )
+
+
+def read_store(store_path, country, uf, geocode, year=None, log=False):
+    files = store_files(store_path, country, uf, geocode, year=year)
+
+    if not files:
+        return pd.DataFrame(columns=RAW_COLUMNS)
+
+    if log:
+        logging.info(f"Reading {len(files)} fragments for geocode {geocode}...")
+
+    return read_fragments(store_path, files)
+
+
+def read_fragments(store_path, files):
+    schema = pa.schema(
+        [field for field in RAW_SCHEMA if field.name != "disease"]
+        + [("fetched_at", pa.timestamp("ms"))]
+        + list(PARTITION_SCHEMA)
+    )
+
+    dataset = ds.dataset(
+        files,
+        schema=schema,
+        format="parquet",
+        partitioning=ds.partitioning(PARTITION_SCHEMA, flavor="hive"),
+        partition_base_dir=store_path,
+    )
+
+    df = dataset.to_table().to_pandas()
+
+    return (
+        df.sort_values("fetched_at", kind="stable")
+        .drop_duplicates(subset=["geocode", "disease", "SE"], keep="last")
+        .reindex(columns=RAW_COLUMNS)
+        .reset_index(drop=True)
+    )
+
+
+def compact_store(store_path, log=False):
+    # Folds the appended fragments of each (partition, geocode) back into a
+    # single file, keeping only the newest version of every week.
+    list_partition = sorted(
+        {os.path.dirname(file) for file in glob.glob(f"{store_path}/**/*.parquet", recursive=True)}
+    )
+
+    for partition_path in list_partition:
+        files = glob.glob(os.path.join(partition_path, "*.parquet"))
+        list_geocode = sorted({os.path.basename(file).split("-")[0] for file in files})
+
+        for geocode in list_geocode:
+            list_file = [
+                file for file in files if os.path.basename(file).startswith(f"{geocode}-")
+            ]
+            if len(list_file) < 2:
+                continue
+
+            compact_fragments(store_path, partition_path, geocode, list_file, log=log)
+
+
+def compact_fragments(store_path, partition_path, geocode, list_file, log=False):
+    # The folded file is written before the fragments are removed; if that is
+    # interrupted, reads still dedupe the leftovers to the same rows.
+    list_file = sorted(list_file)
+
+    df = read_fragments(store_path, list_file)
+    table = add_fetched_at(raw_table(df).drop(["disease"]))
+
+    file_path = os.path.join(partition_path, f"{geocode}-{uuid.uuid4().hex}.parquet")
+    pq.write_table(table, file_path)
+
+    for file in list_file:
+        os.remove(file)
+
+    if log:
+        logging.info(f"Compacted {len(list_file)} fragments into '{file_path}'...")
+
+
+def upsert_frame(df, df_new):
+    return pd.concat([df, df_new], ignore_index=True).drop_duplicates(
+        subset=["disease", "SE"], keep="last"
+    )
+
+
+def read_header(file_path):
+    if not os.path.exists(file_path):
+        return None
+
+    with open(file_path, "r") as f:
+        return f.readline().strip().split(",")
+
+
+def get_journal_path(file_path):
+    return f"{file_path}.journal"
+
+
+def recover_csv(file_path, log=False):
+    # An append interrupted before its journal was removed is undone by
+    # cutting the file back to the size recorded before it started.
+    journal_path = get_journal_path(file_path)
+
+    if not os.path.exists(journal_path):
+        return False
+
+    with open(journal_path, "r") as f:
+        size = f.read().strip()
+
+    # An empty or partial journal means the append itself never started.
+    if size.isdigit() and os.path.exists(file_path):
+        with open(file_path, "r+") as f:
+            f.truncate(int(size))
+            f.flush()
+            os.fsync(f.fileno())
+
+        logging.warning(f"Rolled back an interrupted append to '{file_path}'...")
+
+    os.remove(journal_path)
+
+    return True
+
+
+def append_csv(file_path, df, df_new, log=False):
+    # `df` is what the file currently holds. New weeks are appended in place,
+    # so a write costs the new rows rather than the file; the journal keeps
+    # the previous size for recover_csv(). Only overlapping (disease, SE)
+    # rows or a legacy header force a full rewrite of the RAW_COLUMNS layout.
+    df_new = df_new.drop_duplicates(subset=["disease", "SE"], keep="last").reindex(
+        columns=RAW_COLUMNS
+    )
+    recover_csv(file_path, log=log)
+
+    overlap = False
+    if not df.empty:
+        keys = pd.MultiIndex.from_frame(df[["disease", "SE"]])
+        overlap = pd.MultiIndex.from_frame(df_new[["disease", "SE"]]).isin(keys).any()
+
+    if read_header(file_path) == RAW_COLUMNS and not overlap:
+        journal_path = get_journal_path(file_path)
+        size = os.path.getsize(file_path)
+
+        with open(journal_path, "w") as f:
+            f.write(str(size))
+            f.flush()
+            os.fsync(f.fileno())
+
+        with open(file_path, "a") as f:
+            df_new.to_csv(f, header=False, index=False)
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.remove(journal_path)
+        size = os.path.getsize(file_path) - size
+
+        df = pd.concat([df, df_new], ignore_index=True)
+
+        if log:
+            logging.info(f"Appended {len(df_new)} rows to '{file_path}'...")
+    else:
+        df = upsert_frame(df, df_new).reindex(columns=RAW_COLUMNS)
+        tmp_path = f"{file_path}.tmp"
+
+        with open(tmp_path, "w") as f:
+            df.to_csv(f, index=False)
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(tmp_path, file_path)
+        size = os.path.getsize(file_path)
+
+        if log:
+            logging.info(f"Rewrote '{file_path}' with {len(df)} rows...")
+
+    record_write(file_path, len(df_new), target="csv", size=size)
+
+    return df
@@ -1,9 +1,17 @@
+import codecs
+import json
 import logging
 import pandas as pd
 import os
 import requests
+import threading
+import time
+from urllib.parse import urlparse
 from requests.adapters import HTTPAdapter
 from urllib3.util import Retry
+from src.geography import get_geography, path_column
+from src.metrics import get_metrics
+from src.ratelimit import parse_retry_after
 
 
 def set_logging_config():
@@ -14,29 +22,260 @@ def set_logging_config():
     )
 
 
-def http_response(url, format, max_retries=3, backoff_factor=90, log=False):
-    retry_strategy = Retry(
-        total=max_retries,
-        status_forcelist=[429],
-        allowed_methods=["GET"],
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(max_retries=3, backoff_factor=90, pool_maxsize=10, status_forcelist=(429,)):
+    key = (max_retries, backoff_factor, pool_maxsize, status_forcelist)
+
+    with _sessions_lock:
+        http = _sessions.get(key)
+
+        if http is None:
+            retry_strategy = Retry(
+                total=max_retries,
+                status_forcelist=list(status_forcelist),
+                allowed_methods=["GET"],
+                backoff_factor=backoff_factor,
+                respect_retry_after_header=bool(status_forcelist),
+            )
+
+            adapter = HTTPAdapter(
+                max_retries=retry_strategy,
+                pool_connections=pool_maxsize,
+                pool_maxsize=pool_maxsize,
+            )
+            http = requests.session()
+            http.mount("https://", adapter=adapter)
+            http.mount("http://", adapter=adapter)
+
+            _sessions[key] = http
+
+    return http
+
+
+def http_response(
+    url,
+    format,
+    max_retries=3,
+    backoff_factor=90,
+    pool_maxsize=10,
+    rate_limiter=None,
+    cache=None,
+    fields=None,
+    log=False,
+):
+    content = http_content(
+        url,
+        max_retries=max_retries,
         backoff_factor=backoff_factor,
+        pool_maxsize=pool_maxsize,
+        rate_limiter=rate_limiter,
+        cache=cache,
+        log=log,
     )
 
-    adapter = HTTPAdapter(max_retries=retry_strategy)
-    http = requests.session()
-    http.mount("https://", adapter=adapter)
-    http.mount("http://", adapter=adapter)
+    if format == "json":
+        metrics = get_metrics()
+
+        with metrics.timer("parse", format=format):
+            df = json_frame(iter_json_array(iter_chunks(content)), fields=fields)
+
+        metrics.inc("rows_parsed", len(df))
+        return df
+    else:
+        if log:
+            logging.error(f"Invalid format {format}")
+
+
+def iter_chunks(content, chunk_size=64 * 1024):
+    for start in range(0, len(content), chunk_size):
+        yield content[start : start + chunk_size]
+
+
+def iter_json_array(chunks):
+    # Decodes the elements of a top-level JSON array one at a time, so only
+    # the current element is ever materialised as Python objects.
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    started = False
+
+    for chunk in chunks:
+        buffer += text_decoder.decode(chunk)
+        pos = 0
+
+        while True:
+            while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+                pos += 1
+
+            if pos == len(buffer):
+                break
+
+            if not started:
+                if buffer[pos] != "[":
+                    yield from json_fallback(buffer[pos:], chunks, text_decoder)
+                    return
+                started = True
+                pos += 1
+                continue
+
+            if buffer[pos] == "]":
+                return
+
+            try:
+                item, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                break
+
+            if end == len(buffer):
+                break
+
+            yield item
+            pos = end
+
+        buffer = buffer[pos:]
+
+    if buffer.strip():
+        item, end = decoder.raw_decode(buffer.strip())
+        yield item
+
+
+def json_fallback(buffer, chunks, text_decoder):
+    for chunk in chunks:
+        buffer += text_decoder.decode(chunk)
+
+    data = json.loads(buffer)
+
+    if isinstance(data, list):
+        yield from data
+    else:
+        yield data
+
+
+def json_frame(items, fields=None):
+    if fields is None:
+        return pd.DataFrame.from_records(list(items))
+
+    paths = [field.split(".") for field in fields]
+    columns = {field: [] for field in fields}
+
+    for item in items:
+        for field, path in zip(fields, paths):
+            value = item
+            for key in path:
+                value = value.get(key) if isinstance(value, dict) else None
+            columns[field].append(value)
+
+    return pd.DataFrame(columns)
+
+
+def http_content(
+    url,
+    max_retries=3,
+    backoff_factor=90,
+    pool_maxsize=10,
+    rate_limiter=None,
+    cache=None,
+    log=False,
+):
+    entry = None
+    headers = {}
+    metrics = get_metrics()
+
+    if cache is not None:
+        entry = cache.get(url)
+
+        if entry is not None and entry["fresh"]:
+            if log:
+                logging.info(f"HTTP cache hit {url}")
+            metrics.inc("http_cache", result="hit")
+            return cache.hit(entry)
+
+        headers = cache.validators(entry)
+
+    start = time.perf_counter()
+
+    if rate_limiter is None:
+        http = get_session(
+            max_retries=max_retries,
+            backoff_factor=backoff_factor,
+            pool_maxsize=pool_maxsize,
+        )
+        response = http.get(url, headers=headers)
+    else:
+        response = limited_get(
+            url,
+            rate_limiter=rate_limiter,
+            headers=headers,
+            max_retries=max_retries,
+            backoff_factor=backoff_factor,
+            pool_maxsize=pool_maxsize,
+            log=log,
+        )
+
+    host = urlparse(url).netloc
+    metrics.observe("http_request_seconds", time.perf_counter() - start, host=host)
+    metrics.inc("http_requests", host=host, status=response.status_code)
+    metrics.inc("http_bytes_read", len(response.content), host=host)
 
-    response = http.get(url)
     if log:
         logging.info(f"HTTP GET {url}")
         logging.info(f"HTTP Status Code: {response.status_code}")
 
-    if format == "json":
-        return pd.json_normalize(response.json())
-    else:
+    if response.status_code == 304 and entry is not None:
+        metrics.inc("http_cache", result="revalidated")
+        return cache.refresh(entry)
+
+    if cache is not None and response.status_code == 200:
+        cache.put(
+            url,
+            response.content,
+            etag=response.headers.get("ETag"),
+            last_modified=response.headers.get("Last-Modified"),
+        )
+
+    return response.content
+
+
+def limited_get(
+    url,
+    rate_limiter,
+    headers=None,
+    max_retries=3,
+    backoff_factor=90,
+    pool_maxsize=10,
+    log=False,
+):
+    # 429s are handed back by urllib3 and scheduled by the shared limiter
+    # instead of sleeping backoff_factor seconds inside a single request.
+    http = get_session(
+        max_retries=max_retries,
+        backoff_factor=backoff_factor,
+        pool_maxsize=pool_maxsize,
+        status_forcelist=(),
+    )
+
+    for attempt in range(max_retries + 1):
+        sent = rate_limiter.acquire()
+        response = http.get(url, headers=headers)
+
+        if response.status_code != 429:
+            rate_limiter.success()
+            return response
+
+        get_metrics().inc("http_throttled", host=urlparse(url).netloc)
+        retry_after = parse_retry_after(response.headers.get("Retry-After"))
+        wait = rate_limiter.throttled(retry_after, sent=sent)
+
         if log:
-            logging.error(f"Invalid format {format}")
+            logging.warning(
+                f"HTTP 429 for {url}, waiting {wait:.2f}s "
+                f"(rate {rate_limiter.rate:.2f} requests/s)..."
+            )
+
+    response.raise_for_status()
 
 
 def check_dir(dir_path, log=False):
@@ -57,33 +296,17 @@ def check_file(file_path, type="csv"):
             return True
         else:
             with open(file_path, "r") as f:
-                lines = f.readlines()
-                lines_without_space = [line.strip() for line in lines if line.strip()]
-                if lines_without_space:
-                    exists = True
+                exists = any(line.strip() for line in f)
 
     return exists
 
 
-def mask_uf(df, list_uf, log=False):
-    if log:
-        logging.info(f"Masking uf {list_uf}...")
-
-    mask_ufs = df["mesorregiao_uf"].isin(list_uf)
-
-    return mask_ufs
-
-
-def mask_city(df, list_city, log=False):
-    if log:
-        logging.info(f"Masking city {list_city}...")
-
-    mask_cities = df["municipio"].isin(list_city)
-
-    return mask_cities
+def get_url_resp(
+    url, disease, geocode, format, ew_start, ew_end, year, ey_end=None, log=False
+):
+    if ey_end is None:
+        ey_end = year
 
-
-def get_url_resp(url, disease, geocode, format, ew_start, ew_end, year, log=False):
     params_url = (
         "&disease="
         + f"{disease}"
@@ -98,7 +321,7 @@ def get_url_resp(url, disease, geocode, format, ew_start, ew_end, year, log=Fals
         + "&ey_start="
         + f"{year}"
         + "&ey_end="
-        + f"{year}"
+        + f"{ey_end}"
     )
 
     return "?".join([url, params_url])
@@ -107,18 +330,11 @@ def get_url_resp(url, disease, geocode, format, ew_start, ew_end, year, log=Fals
 def set_csv_path(params, uf=False, country=False, log=False):
     df = params["ibge_data"]
 
-    if uf:
-        return df.apply(
-        lambda row: f"data/{params["country"]}/{row['mesorregiao_uf'].lower()}",
-        axis=1,
-    )
-    elif country:
-        return df.apply(
-        lambda row: f"data/{params["country"]}",
-        axis=1,
+    if country:
+        return path_column(df, params["country"], level="country")
+
+    paths = get_geography(params).get_paths(
+        df["geocode"], level="uf" if uf else "city"
     )
-    else:
-        return df.apply(
-            lambda row: f"data/{params["country"]}/{row['mesorregiao_uf'].lower()}/{row['geocode']}",
-            axis=1,
-        )
+
+    return pd.Series(paths, index=df.index)